@@ -0,0 +1,172 @@
+import math
+import bisect
+from datetime import datetime
+from array import array
+from collections import namedtuple, OrderedDict
+
+from gtfs_map import DEFAULT_TRIP_CACHE_SIZE
+from stop_times_index import seconds_since_midnight, SECONDS_PER_DAY
+
+# vehicles further than this from their trip's path get no delay
+MAX_OFF_ROUTE_METERS = 500
+
+# A trip's stops as meters along its path with their scheduled arrival_secs,
+# distances never decreasing. The path is the trip's shape when shape_id is
+# set, otherwise the straight lines between its stops, projected to xs, ys.
+_TripProfile = namedtuple('_TripProfile', ['shape_id', 'distances', 'arrivals', 'xs', 'ys'])
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# Estimates how far behind schedule each vehicle is, by projecting its
+# position onto its trip's shape and interpolating the scheduled time between
+# the stops either side. Each trip's stops are located on its shape once and
+# kept in an LRU cache, so a cycle only reads the trips which are new since
+# the last one.
+class ScheduleAdherence(object):
+    def __init__(self, gtfs_map, cache_size=DEFAULT_TRIP_CACHE_SIZE, max_distance=MAX_OFF_ROUTE_METERS):
+        if gtfs_map.spatial_index is None:
+            raise Exception("Schedule adherence needs a GtfsMap created with spatial=True")
+        self._gtfs_map = gtfs_map
+        self._index = gtfs_map.spatial_index
+        self._generation = gtfs_map.feed_generation
+        self._cache_size = cache_size
+        self.max_distance = max_distance
+        # trip_id -> _TripProfile, or None for trips without usable stop times
+        self._profiles = OrderedDict()
+        # (shape_id, stop lat, stop lon) -> locate_on_shape(), shared by the many trips on a shape
+        self._stops_on_shapes = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _profile(self, trip_id, rows):
+        index = self._index
+        stops = []
+        for row in rows:
+            lat = _float(row["stop_lat"])
+            lon = _float(row["stop_lon"])
+            if lat is not None and lon is not None and row["arrival_secs"] is not None:
+                stops.append((lat, lon, row["arrival_secs"]))
+        if not stops:
+            return None
+
+        shape = index.trip_shapes.get(trip_id)
+        shape_id = None if shape is None else index.shape_ids[shape]
+        distances = array('d')
+        xs = array('d')
+        ys = array('d')
+        if shape_id is not None:
+            for lat, lon, arrival_secs in stops:
+                key = (shape_id, lat, lon)
+                if key in self._stops_on_shapes:
+                    located = self._stops_on_shapes[key]
+                else:
+                    located = self._stops_on_shapes[key] = index.locate_on_shape(lat, lon, shape_id, self.max_distance)
+                if located is None:
+                    # a stop off its own shape, fall back to the stops
+                    shape_id = None
+                    break
+                # a shape which loops back past a stop could place it behind the last one
+                distances.append(max(located[0], distances[-1] if distances else 0.0))
+        if shape_id is None:
+            distances = array('d')
+            for lat, lon, arrival_secs in stops:
+                x, y = index.project(lat, lon)
+                distances.append(distances[-1] + math.hypot(x - xs[-1], y - ys[-1]) if xs else 0.0)
+                xs.append(x)
+                ys.append(y)
+        return _TripProfile(shape_id=shape_id, distances=distances, arrivals=array('i', [arrival_secs for lat, lon, arrival_secs in stops]),
+                            xs=xs, ys=ys)
+
+    # trip_id -> _TripProfile for trip_ids, reading the ones not cached in one go
+    def _load(self, trip_ids):
+        cache = self._profiles
+        profiles = {}
+        missing = []
+        for trip_id in trip_ids:
+            if trip_id in cache:
+                cache.move_to_end(trip_id)
+                profiles[trip_id] = cache[trip_id]
+            else:
+                missing.append(trip_id)
+        self.cache_hits += len(profiles)
+        self.cache_misses += len(missing)
+        for trip_id, rows in self._gtfs_map.find_stop_times_for_trips(missing).items():
+            profiles[trip_id] = cache[trip_id] = self._profile(trip_id, rows)
+        while len(cache) > self._cache_size:
+            cache.popitem(last=False)
+        return profiles
+
+    # (meters along the straight lines between the profile's stops, meters off them)
+    def _locate_on_stops(self, profile, lat, lon):
+        x, y = self._index.project(lat, lon)
+        xs = profile.xs
+        ys = profile.ys
+        if len(xs) == 1:
+            return 0.0, math.hypot(x - xs[0], y - ys[0])
+        best = None
+        for i in range(len(xs) - 1):
+            dx = xs[i + 1] - xs[i]
+            dy = ys[i + 1] - ys[i]
+            length = dx * dx + dy * dy
+            t = 0.0 if length == 0 else max(0.0, min(1.0, ((x - xs[i]) * dx + (y - ys[i]) * dy) / length))
+            distance = math.hypot(xs[i] + t * dx - x, ys[i] + t * dy - y)
+            if best is None or distance < best[1]:
+                best = (profile.distances[i] + t * math.sqrt(length), distance)
+        return best
+
+    # scheduled arrival_secs at meters along the profile's path
+    def _scheduled_secs(self, profile, along):
+        distances = profile.distances
+        arrivals = profile.arrivals
+        i = bisect.bisect_right(distances, along)
+        if i == 0:
+            return arrivals[0]
+        if i == len(distances):
+            return arrivals[-1]
+        span = distances[i] - distances[i - 1]
+        if span == 0:
+            return arrivals[i]
+        return arrivals[i - 1] + (arrivals[i] - arrivals[i - 1]) * (along - distances[i - 1]) / span
+
+    # Seconds behind schedule for each gtfs_map.Location, as of the time its
+    # position was reported or date, the feed's, for vehicles without one.
+    # Negative when early and None for vehicles without a known trip or too
+    # far from it.
+    def delays(self, locations, date):
+        if self._gtfs_map.feed_generation != self._generation or self._gtfs_map.spatial_index is not self._index:
+            # the static feed was refreshed, any table may hold different stop times
+            self._generation = self._gtfs_map.feed_generation
+            self._index = self._gtfs_map.spatial_index
+            self._profiles = OrderedDict()
+            self._stops_on_shapes = {}
+
+        locations = list(locations)
+        profiles = self._load(set(location.trip_id for location in locations if location.trip_id))
+        feed_now = seconds_since_midnight(date)
+        delays = []
+        for location in locations:
+            profile = profiles.get(location.trip_id) if location.trip_id else None
+            if profile is None or location.lat is None or location.lon is None:
+                delays.append(None)
+                continue
+            if profile.shape_id is not None:
+                located = self._index.locate_on_shape(location.lat, location.lon, profile.shape_id, self.max_distance)
+            else:
+                located = self._locate_on_stops(profile, location.lat, location.lon)
+            if located is None or located[1] > self.max_distance:
+                delays.append(None)
+                continue
+            scheduled = self._scheduled_secs(profile, located[0])
+            now = feed_now if location.timestamp is None else seconds_since_midnight(datetime.fromtimestamp(location.timestamp))
+            # trips from yesterday's service which run past midnight are scheduled after 24:00
+            delays.append(int(round(min(now - scheduled, now + SECONDS_PER_DAY - scheduled, key=abs))))
+        return delays
+
+    # locations with their delay filled in
+    def with_delays(self, locations, date):
+        locations = list(locations)
+        return [location._replace(delay=delay) for location, delay in zip(locations, self.delays(locations, date))]
@@ -0,0 +1,103 @@
+import hashlib
+from collections import namedtuple
+
+# translations in this language, or without one, are stored over the others
+DEFAULT_LANGUAGE = "en"
+
+# What an alert applies to. Fields the feed left out are None; an entity
+# naming both a route and a stop only covers that stop on that route, but is
+# indexed under each.
+InformedEntity = namedtuple('InformedEntity', ['agency_id', 'route_id', 'route_type', 'trip_id', 'stop_id'])
+
+# An alert from the realtime feed. alert_hash identifies its content, so an
+# alert which runs for hours hashes the same every cycle. active_periods are
+# (start, end) POSIX times, either None when open ended, and no periods means
+# always active.
+Alert = namedtuple('Alert', ['alert_hash', 'alert_id', 'cause', 'effect', 'header_text', 'description_text', 'url',
+                             'active_periods', 'informed_entities'])
+
+# the InformedEntity fields AlertIndex looks alerts up by
+INDEXED_FIELDS = ("agency_id", "route_id", "route_type", "trip_id", "stop_id")
+
+def _text(translated_string, language=DEFAULT_LANGUAGE):
+    translations = translated_string.translation
+    if not translations:
+        return None
+    for translation in translations:
+        if translation.language in (language, ""):
+            return translation.text
+    return translations[0].text
+
+def _optional(message, field):
+    return getattr(message, field) if message.HasField(field) else None
+
+def alert_hash(entity):
+    digest = hashlib.sha1(entity.id.encode("utf-8"))
+    digest.update(entity.alert.SerializeToString())
+    return digest.hexdigest()
+
+def iter_alerts(alert_message):
+    for entity in alert_message.entity:
+        if not entity.HasField("alert"):
+            continue
+        alert = entity.alert
+        periods = tuple((_optional(period, "start"), _optional(period, "end")) for period in alert.active_period)
+        entities = tuple(InformedEntity(agency_id=_optional(selector, "agency_id"), route_id=_optional(selector, "route_id"),
+                                        route_type=_optional(selector, "route_type"),
+                                        trip_id=selector.trip.trip_id if selector.HasField("trip") and selector.trip.HasField("trip_id") else None,
+                                        stop_id=_optional(selector, "stop_id"))
+                         for selector in alert.informed_entity)
+        yield Alert(alert_hash=alert_hash(entity), alert_id=entity.id, cause=_optional(alert, "cause"), effect=_optional(alert, "effect"),
+                    header_text=_text(alert.header_text), description_text=_text(alert.description_text), url=_text(alert.url),
+                    active_periods=periods, informed_entities=entities)
+
+def is_active(alert, timestamp):
+    if not alert.active_periods:
+        return True
+    for start, end in alert.active_periods:
+        if (start is None or start <= timestamp) and (end is None or timestamp <= end):
+            return True
+    return False
+
+# The alerts from one feed snapshot, indexed by each informed entity field so
+# finding those which affect a stop, route, trip or route type is a dict
+# lookup rather than a scan. timestamp is the feed's, and the default time
+# alerts are checked against their active periods at.
+class AlertIndex(object):
+    def __init__(self, alerts=(), timestamp=None):
+        self.timestamp = timestamp
+        self.alerts = {}
+        # field -> value -> alert_hashes
+        self._entities = dict((field, {}) for field in INDEXED_FIELDS)
+        for alert in alerts:
+            self.alerts[alert.alert_hash] = alert
+            for entity in alert.informed_entities:
+                for field in INDEXED_FIELDS:
+                    value = getattr(entity, field)
+                    if value is not None:
+                        self._entities[field].setdefault(value, set()).add(alert.alert_hash)
+
+    def __len__(self):
+        return len(self.alerts)
+
+    # Alerts active at timestamp which name any of the given stop_id,
+    # route_id, trip_id, route_type or agency_id
+    def affecting(self, stop_id=None, route_id=None, trip_id=None, route_type=None, agency_id=None, timestamp=None):
+        if timestamp is None:
+            timestamp = self.timestamp
+        hashes = set()
+        for field, value in (("stop_id", stop_id), ("route_id", route_id), ("trip_id", trip_id), ("route_type", route_type),
+                             ("agency_id", agency_id)):
+            if value is not None:
+                hashes.update(self._entities[field].get(value, ()))
+        alerts = [self.alerts[alert_hash] for alert_hash in hashes]
+        if timestamp is not None:
+            alerts = [alert for alert in alerts if is_active(alert, timestamp)]
+        return sorted(alerts, key=lambda alert: alert.alert_id)
+
+    # every alert active at timestamp
+    def active(self, timestamp=None):
+        if timestamp is None:
+            timestamp = self.timestamp
+        return sorted((alert for alert in self.alerts.values() if timestamp is None or is_active(alert, timestamp)),
+                      key=lambda alert: alert.alert_id)
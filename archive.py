@@ -0,0 +1,157 @@
+import os
+import gzip
+import time
+import struct
+import hashlib
+from collections import namedtuple
+
+# chunk files are closed and a new one started once they pass this size
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_COMPRESSLEVEL = 6
+
+# fetched_at, feed header timestamp, chunk, offset, compressed length, sha1
+INDEX_RECORD = struct.Struct("<qqIQI20s")
+
+ArchiveEntry = namedtuple('ArchiveEntry', ['fetched_at', 'timestamp', 'chunk', 'offset', 'length', 'sha1'])
+
+def _chunk_path(directory, name, chunk):
+    return os.path.join(directory, "%s-%06d.gz" % (name, chunk))
+
+# The archive of one feed: <name>-NNNNNN.gz chunks of gzip members, one per
+# payload, and <name>.idx with a fixed size record per fetch, ordered by
+# fetched_at
+class _FeedLog(object):
+    def __init__(self, directory, name, chunk_size, compresslevel):
+        self.directory = directory
+        self.name = name
+        self.chunk_size = chunk_size
+        self.compresslevel = compresslevel
+
+        index_path = os.path.join(directory, name + ".idx")
+        self._index = open(index_path, "a+b")
+        # a record cut short by a crash is dropped
+        size = os.path.getsize(index_path)
+        if size % INDEX_RECORD.size:
+            self._index.truncate(size - size % INDEX_RECORD.size)
+        self.count = os.path.getsize(index_path) // INDEX_RECORD.size
+
+        # payloads already in the current chunk, sha1 -> entry
+        self._stored = {}
+        self.chunk = 0
+        if self.count:
+            last = self.entry(self.count - 1)
+            self.chunk = last.chunk
+            for i in range(self.count - 1, -1, -1):
+                entry = self.entry(i)
+                if entry.chunk != self.chunk:
+                    break
+                self._stored.setdefault(entry.sha1, entry)
+        self._chunk_file = open(_chunk_path(directory, name, self.chunk), "ab")
+
+    def entry(self, i):
+        self._index.seek(i * INDEX_RECORD.size)
+        return ArchiveEntry(*INDEX_RECORD.unpack(self._index.read(INDEX_RECORD.size)))
+
+    # first record with fetched_at >= value, by binary search over the index file
+    def bisect(self, fetched_at):
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid).fetched_at < fetched_at:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def append(self, data, timestamp, fetched_at):
+        sha1 = hashlib.sha1(data).digest()
+        stored = self._stored.get(sha1)
+        if stored is None:
+            if self._chunk_file.tell() >= self.chunk_size:
+                self._chunk_file.close()
+                self.chunk += 1
+                self._stored = {}
+                self._chunk_file = open(_chunk_path(self.directory, self.name, self.chunk), "ab")
+            member = gzip.compress(data, self.compresslevel)
+            offset = self._chunk_file.tell()
+            self._chunk_file.write(member)
+            # the payload goes down before the record pointing at it
+            self._chunk_file.flush()
+            entry = ArchiveEntry(fetched_at, timestamp or 0, self.chunk, offset, len(member), sha1)
+            self._stored[sha1] = entry
+        else:
+            entry = stored._replace(fetched_at=fetched_at, timestamp=timestamp or 0)
+
+        self._index.seek(0, os.SEEK_END)
+        self._index.write(INDEX_RECORD.pack(*entry))
+        self._index.flush()
+        self.count += 1
+        return stored is None
+
+    def read(self, entry):
+        if entry.chunk == self.chunk:
+            self._chunk_file.flush()
+        with open(_chunk_path(self.directory, self.name, entry.chunk), "rb") as f:
+            f.seek(entry.offset)
+            return gzip.decompress(f.read(entry.length))
+
+    def close(self):
+        self._chunk_file.close()
+        self._index.close()
+
+# Append-only archive of raw realtime feed payloads, so predictions can be
+# replayed later. Each payload is stored once per chunk, identical fetches
+# only add an index record pointing at it. Lookups by fetch time are a binary
+# search over the index.
+class FeedArchive(object):
+    def __init__(self, directory, chunk_size=DEFAULT_CHUNK_SIZE, compresslevel=DEFAULT_COMPRESSLEVEL):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.compresslevel = compresslevel
+        self._logs = {}
+
+    def _log(self, name):
+        log = self._logs.get(name)
+        if log is None:
+            log = _FeedLog(self.directory, name, self.chunk_size, self.compresslevel)
+            self._logs[name] = log
+        return log
+
+    def names(self):
+        return sorted(name[:-len(".idx")] for name in os.listdir(self.directory) if name.endswith(".idx"))
+
+    # returns False when the payload was already in the archive
+    def append(self, name, data, timestamp, fetched_at=None):
+        if fetched_at is None:
+            fetched_at = int(time.time())
+        return self._log(name).append(data, timestamp, fetched_at)
+
+    # entries fetched in [start, end), either of which can be None
+    def entries(self, name, start=None, end=None):
+        log = self._log(name)
+        i = 0 if start is None else log.bisect(start)
+        while i < log.count:
+            entry = log.entry(i)
+            if end is not None and entry.fetched_at >= end:
+                return
+            yield entry
+            i += 1
+
+    # the last entry fetched at or before fetched_at, or None
+    def entry_at(self, name, fetched_at):
+        log = self._log(name)
+        i = log.bisect(fetched_at + 1)
+        if i == 0:
+            return None
+        return log.entry(i - 1)
+
+    def read(self, name, entry):
+        return self._log(name).read(entry)
+
+    def close(self):
+        for log in self._logs.values():
+            log.close()
+        self._logs = {}
@@ -0,0 +1,40 @@
+import os
+import argparse
+import datetime
+
+from predictions import list_partitions, service_date, compact_partition, export_partition
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact or export the closed partitions written by run.py --partition-dir")
+    parser.add_argument("partition_dir")
+    parser.add_argument("command", choices=["list", "compact", "export"])
+    parser.add_argument("--before", help="Only partitions before this service date, YYYYMMDD. Defaults to the current service date")
+    parser.add_argument("--output-dir", help="Where export writes .csv.gz files, defaults to partition_dir")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.partition_dir):
+        raise Exception("partition_dir is not a directory")
+
+    # the current partition is still being written to
+    if args.before:
+        before = datetime.datetime.strptime(args.before, "%Y%m%d").date()
+    else:
+        before = service_date(datetime.datetime.now())
+    output_dir = args.output_dir or args.partition_dir
+
+    for date, path in list_partitions(args.partition_dir):
+        if date >= before:
+            continue
+        if args.command == "list":
+            print("%s %s %.1f MB" % (date, path, os.path.getsize(path) / 1e6))
+        elif args.command == "compact":
+            size = os.path.getsize(path)
+            compact_partition(path)
+            print("Compacted %s from %.1f MB to %.1f MB" % (path, size / 1e6, os.path.getsize(path) / 1e6))
+        else:
+            output_path = os.path.join(output_dir, os.path.basename(path)[:-len(".db")] + ".csv.gz")
+            count = export_partition(path, output_path)
+            print("Exported %d predictions to %s" % (count, output_path))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import time
+import hashlib
+import argparse
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from gtfs_map import GtfsMap
+from feeds import FeedFetcher, FETCH_MODES
+import run
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# serves <feed name>.pb files from a directory, as a stand-in for the MBTA
+def make_handler(pb_dir, latency):
+    class CannedFeedHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            path = os.path.join(pb_dir, os.path.basename(self.path))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            with open(path, "rb") as f:
+                data = f.read()
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()
+            time.sleep(latency)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return CannedFeedHandler
+
+def serve(pb_dir, latency):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(pb_dir, latency))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Time run.calculate end to end against canned feeds served locally")
+    parser.add_argument("gtfs_path")
+    parser.add_argument("pb_dir", help="Directory with trip_updates.pb, vehicle_positions.pb and alerts.pb")
+    parser.add_argument("--db-path", default="./temp_gtfs.db")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds the server waits before answering")
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--unchanged", action="store_true", help="Mark each cycle processed, so later cycles see unchanged feeds")
+    parser.add_argument("--modes", nargs="+", choices=FETCH_MODES, default=FETCH_MODES)
+    args = parser.parse_args()
+
+    server = serve(args.pb_dir, args.latency)
+    base_url = "http://127.0.0.1:%d/" % server.server_address[1]
+    urls = dict((name, base_url + name + ".pb") for name in run.FEEDS)
+    gtfs_map = GtfsMap(args.gtfs_path, False, db_path=args.db_path)
+
+    for mode in args.modes:
+        try:
+            fetcher = FeedFetcher(urls, mode, run.FEED_TIMEOUTS, required=run.REQUIRED_FEEDS)
+            timings = []
+            for cycle in range(args.cycles):
+                start = time.time()
+                run.calculate(gtfs_map, True, fetcher)
+                timings.append(time.time() - start)
+                if args.unchanged:
+                    fetcher.mark_processed()
+            fetcher.close()
+        except Exception as e:
+            print("%s: %s" % (mode, e))
+            continue
+        print("%-8s best %.3fs  mean %.3fs" % (mode, min(timings), sum(timings) / len(timings)))
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
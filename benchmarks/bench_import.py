@@ -0,0 +1,42 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from gtfs_map import GtfsMap
+from benchmarks.synthetic_gtfs import write_feed
+
+def time_build(gtfs_path, db_path, bulk_load):
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    start = time.time()
+    gtfs_map = GtfsMap(gtfs_path, True, bulk_load=bulk_load, db_path=db_path)
+    # GtfsMap commits and closes when it goes away
+    del gtfs_map
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a cold GtfsMap build against a synthetic feed")
+    parser.add_argument("--routes", type=int, default=20)
+    parser.add_argument("--trips-per-route", type=int, default=200)
+    parser.add_argument("--stops-per-trip", type=int, default=30)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        gtfs_path = os.path.join(directory, "gtfs")
+        rows = write_feed(gtfs_path, args.routes, args.trips_per_route, args.stops_per_trip)
+        db_path = os.path.join(directory, "gtfs.db")
+
+        default = time_build(gtfs_path, db_path, False)
+        bulk = time_build(gtfs_path, db_path, True)
+
+        print("stop_times rows: %d" % rows)
+        print("default import: %.2fs" % default)
+        print("bulk import:    %.2fs (%.1fx)" % (bulk, default / bulk))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import time
+import argparse
+
+from feeds import parse_feed
+from wire import scan_trip_updates, scan_vehicle_positions
+
+# the same tuples as the wire scanners, from gtfs_realtime_pb2 messages
+def protobuf_trip_updates(message):
+    for entity in message.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        trip_id = entity.trip_update.trip.trip_id
+        for stop_time_update in entity.trip_update.stop_time_update:
+            arrival_time = None
+            arrival_delay = None
+            if stop_time_update.HasField("arrival"):
+                if stop_time_update.arrival.HasField("time"):
+                    arrival_time = stop_time_update.arrival.time
+                if stop_time_update.arrival.HasField("delay"):
+                    arrival_delay = stop_time_update.arrival.delay
+            yield (trip_id, stop_time_update.stop_id, stop_time_update.stop_sequence, arrival_time, arrival_delay,
+                   stop_time_update.schedule_relationship)
+
+def protobuf_vehicle_positions(message):
+    for entity in message.entity:
+        if not entity.HasField("vehicle"):
+            continue
+        vehicle = entity.vehicle
+        yield (vehicle.trip.trip_id, vehicle.stop_id, vehicle.position.latitude, vehicle.position.longitude,
+               vehicle.timestamp if vehicle.HasField("timestamp") else None)
+
+def best_of(repeat, function, data):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        count = sum(1 for row in function(data))
+        timings.append(time.time() - start)
+    return min(timings), count
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the wire scanners against gtfs_realtime_pb2 on recorded feeds and compare throughput")
+    parser.add_argument("trip_updates", nargs="*", default=[], help="Recorded TripUpdates .pb files")
+    parser.add_argument("--vehicle-positions", nargs="*", default=[], help="Recorded VehiclePositions .pb files")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    checks = [(path, protobuf_trip_updates, scan_trip_updates) for path in args.trip_updates]
+    checks += [(path, protobuf_vehicle_positions, scan_vehicle_positions) for path in args.vehicle_positions]
+    for path, protobuf, scanner in checks:
+        with open(path, "rb") as f:
+            data = f.read()
+        if list(protobuf(parse_feed(data))) != list(scanner(data)):
+            raise Exception("%s: scanner output differs from gtfs_realtime_pb2" % path)
+
+        parsed, count = best_of(args.repeat, lambda data: protobuf(parse_feed(data)), data)
+        scanned, count = best_of(args.repeat, scanner, data)
+        megabytes = len(data) / 1e6
+        print("%s  %d rows" % (path, count))
+        print("  ParseFromString %.3fs (%.1f MB/s)  scanner %.3fs (%.1f MB/s)  %.1fx" %
+              (parsed, megabytes / parsed, scanned, megabytes / scanned, parsed / scanned))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+from gtfs_map import Prediction
+from predictions import PredictionsStore
+
+FORMATS = [("original", {}),
+           ("compact", {"compact": True}),
+           ("compact-without-rowid", {"compact": True, "without_rowid": True}),
+           ("delta", {"delta": True}),
+           ("compact-delta", {"compact": True, "without_rowid": True, "delta": True})]
+
+# predictions count down towards an arrival within the next half hour, a few
+# get pushed back by realtime updates each minute
+def synthetic_minutes(cycles, size, stops=8000, trips=20000, updated=0.02):
+    start = datetime(2015, 6, 1, 6, 0)
+    def new_arrival(now):
+        return ("stop-%d" % random.randrange(stops), "trip-%d" % random.randrange(trips)), now + random.randrange(60, 30 * 60)
+    arrivals = dict(new_arrival(0) for i in range(size))
+    for cycle in range(cycles):
+        now = 60 * cycle
+        predictions = []
+        for key, arrival in list(arrivals.items()):
+            if random.random() < updated:
+                arrival += random.randrange(-60, 180)
+                arrivals[key] = arrival
+            if arrival <= now:
+                del arrivals[key]
+                key, arrival = new_arrival(now)
+                arrivals[key] = arrival
+            predictions.append(Prediction(stop_id=key[0], trip_id=key[1], estimated_minutes=(arrival - now) // 60))
+        yield start + timedelta(0, now), predictions
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare size and scan speed of the PredictionsStore formats")
+    parser.add_argument("--predictions", type=int, default=20000, help="Predictions written per minute")
+    parser.add_argument("--cycles", type=int, default=60, help="Minutes of predictions to write")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        for name, options in FORMATS:
+            random.seed(0)
+            path = os.path.join(directory, name + ".db")
+            store = PredictionsStore(path, **options)
+
+            start = time.time()
+            for date, predictions in synthetic_minutes(args.cycles, args.predictions):
+                store.add_predictions(predictions, date)
+                store.commit()
+            write_elapsed = time.time() - start
+            store._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+            # one slice in the middle, then everything
+            middle = datetime(2015, 6, 1, 6, 0) + timedelta(0, 60 * (args.cycles // 2))
+            start = time.time()
+            sliced = sum(1 for row in store.find_predictions(middle, middle + timedelta(0, 60 * 5)))
+            slice_elapsed = time.time() - start
+            start = time.time()
+            total = sum(1 for row in store.find_predictions(datetime(2015, 1, 1), datetime(2016, 1, 1)))
+            scan_elapsed = time.time() - start
+
+            print("%-22s %7.1f MB  write %.2fs  5 minute slice %.3fs (%d rows)  full scan %.2fs (%d rows)" %
+                  (name, os.path.getsize(path) / 1e6, write_elapsed, slice_elapsed, sliced, scan_elapsed, total))
+            if options.get("delta"):
+                start = time.time()
+                rebuilt = len(store.snapshot_at(middle))
+                print("%-22s rebuilt snapshot of %d predictions in %.3fs" % ("", rebuilt, time.time() - start))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+from gtfs_map import Prediction, Location
+from predictions import PredictionsStore
+
+def synthetic_cycle(size, stops=8000, trips=20000):
+    predictions = [Prediction(stop_id="stop-%d" % random.randrange(stops),
+                              trip_id="trip-%d" % random.randrange(trips),
+                              estimated_minutes=random.randrange(30)) for i in range(size)]
+    locations = [Location(trip_id="trip-%d" % random.randrange(trips), lat=42.3 + random.random() / 10,
+                          lon=-71.1 + random.random() / 10, stop_id="stop-%d" % random.randrange(stops)) for i in range(size // 20)]
+    return predictions, locations
+
+def per_row(store, predictions, locations, date):
+    for prediction in predictions:
+        store.add_prediction(prediction, date)
+    for location in locations:
+        store.add_location(location, date)
+    store.commit()
+
+def batched(store, predictions, locations, date):
+    store.add_predictions(predictions, date)
+    store.add_locations(locations, date)
+    store.commit()
+
+def run(write, path, cycles, predictions, locations):
+    if os.path.exists(path):
+        os.remove(path)
+    store = PredictionsStore(path)
+    date = datetime(2015, 6, 1, 8, 0)
+    start = time.time()
+    for cycle in range(cycles):
+        write(store, predictions, locations, date + timedelta(0, 60 * cycle))
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare PredictionsStore write throughput, per row against batched")
+    parser.add_argument("--predictions", type=int, default=30000, help="Predictions written per cycle")
+    parser.add_argument("--cycles", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    predictions, locations = synthetic_cycle(args.predictions)
+    rows = args.cycles * (len(predictions) + len(locations))
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "predictions.db")
+        for name, write in [("per-row", per_row), ("batched", batched)]:
+            elapsed = run(write, path, args.cycles, predictions, locations)
+            print("%-8s %.2fs  %d rows/sec" % (name, elapsed, rows / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
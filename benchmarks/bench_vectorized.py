@@ -0,0 +1,67 @@
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from datetime import datetime
+
+from gtfs_map import GtfsMap
+from predictions import PredictionsStore
+from vectorized import ScheduleArrays, to_predictions
+from benchmarks.synthetic_gtfs import write_feed
+import run
+
+def best_of(repeat, function, *args):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        timings.append(time.time() - start)
+    return min(timings), result
+
+def write(store_path, add, predictions, date):
+    if os.path.exists(store_path):
+        os.remove(store_path)
+    store = PredictionsStore(store_path)
+    add(store)(predictions, date)
+    store.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the scheduled prediction loop in run.py with the NumPy path")
+    parser.add_argument("--routes", type=int, default=40)
+    parser.add_argument("--trips-per-route", type=int, default=400)
+    parser.add_argument("--stops-per-trip", type=int, default=30)
+    parser.add_argument("--updated", type=float, default=0.3, help="Fraction of scheduled stops covered by realtime updates")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        gtfs_path = os.path.join(directory, "gtfs")
+        write_feed(gtfs_path, args.routes, args.trips_per_route, args.stops_per_trip)
+        gtfs_map = GtfsMap(gtfs_path, True, in_memory=True, db_path=os.path.join(directory, "gtfs.db"))
+        arrays = ScheduleArrays(gtfs_map.stop_times_index)
+
+        for date in [datetime(2015, 6, 10, 8, 0), datetime(2015, 6, 11, 0, 30)]:
+            random.seed(0)
+            used_trips = set((row["stop_id"], row["trip_id"], row["stop_sequence"])
+                             for row in gtfs_map.find_stop_times_for_datetime(date) if random.random() < args.updated)
+
+            loop, predictions = best_of(args.repeat, lambda: list(run.iter_scheduled(date, gtfs_map, used_trips)))
+            vector, columns = best_of(args.repeat, arrays.scheduled_columns, date, used_trips)
+            if sorted(predictions) != sorted(to_predictions(columns)):
+                raise Exception("NumPy predictions differ from the loop at %s" % date)
+
+            store_path = os.path.join(directory, "predictions.db")
+            rows, x = best_of(args.repeat, write, store_path, lambda store: store.add_predictions, predictions, date)
+            column_rows, x = best_of(args.repeat, write, store_path, lambda store: store.add_prediction_columns, columns, date)
+
+            print("%s  %d predictions" % (date, len(predictions)))
+            print("  compute  loop %.4fs  numpy %.4fs (%.1fx)" % (loop, vector, loop / vector))
+            print("  write    rows %.4fs  columns %.4fs" % (rows, column_rows))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from datetime import datetime
+
+from gtfs_map import GtfsMap
+from predictions import PredictionsStore
+from feeds import parse_feed
+from benchmarks.synthetic_gtfs import write_feed, CALENDAR_PATTERNS
+from benchmarks.synthetic_realtime import read_stops, realtime_feeds
+import run
+
+# polls spread over a weekday and a saturday, including after midnight
+DATES = [datetime(2015, 6, 10, hour, 15) for hour in (0, 6, 8, 12, 17, 22)] + \
+        [datetime(2015, 6, 13, hour, 45) for hour in (1, 9, 14, 20)]
+
+# a stage regresses when it's this much slower, or uses this much more
+# memory, than the baseline
+DEFAULT_TOLERANCE = 0.25
+# differences smaller than these are noise, whatever the tolerance
+MIN_DIFFERENCE = {"seconds": 0.02, "peak_rss_kb": 1024}
+
+# Runs function once, returning (seconds, peak RSS in KB, rows), where rows is
+# what function returns
+def measure(function):
+    run.reset_peak_rss()
+    start = time.time()
+    rows = function()
+    return time.time() - start, run.peak_rss(), rows
+
+def best_of(repeat, function):
+    results = [measure(function) for i in range(repeat)]
+    return min(results, key=lambda result: result[0])
+
+def count(iterable):
+    return sum(1 for item in iterable)
+
+def stage_result(seconds, peak_rss_kb, rows):
+    return {"seconds": seconds, "peak_rss_kb": peak_rss_kb, "rows": rows, "rows_per_second": rows / max(seconds, 1e-9)}
+
+# {stage: stage_result()} for the collector's stages against a synthetic feed
+def run_suite(directory, config, repeat):
+    gtfs_path = os.path.join(directory, "gtfs")
+    write_feed(gtfs_path, config["routes"], config["trips_per_route"], config["stops_per_trip"],
+               calendar=config["calendar"], holidays=config["holidays"])
+    db_path = os.path.join(directory, "gtfs.db")
+    stages = {}
+
+    def import_feed():
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        gtfs_map = GtfsMap(gtfs_path, True, bulk_load=True, db_path=db_path)
+        del gtfs_map
+        return config["routes"] * config["trips_per_route"] * config["stops_per_trip"]
+    stages["gtfs_import"] = stage_result(*measure(import_feed))
+
+    gtfs_map = GtfsMap(gtfs_path, False, db_path=db_path)
+    stages["find_stop_times_for_datetime"] = stage_result(
+        *best_of(repeat, lambda: sum(count(gtfs_map.find_stop_times_for_datetime(date)) for date in DATES)))
+    in_memory_map = GtfsMap(gtfs_path, False, db_path=db_path, in_memory=True)
+    stages["find_stop_times_in_memory"] = stage_result(
+        *best_of(repeat, lambda: sum(count(in_memory_map.find_stop_times_for_datetime(date)) for date in DATES)))
+
+    stops = read_stops(gtfs_path)
+    feeds = [realtime_feeds(gtfs_map, stops, date, config["updated"], config["delayed"], seed=i)[0].SerializeToString()
+             for i, date in enumerate(DATES)]
+    messages = [parse_feed(data) for data in feeds]
+    stages["parse_trip_updates"] = stage_result(
+        *best_of(repeat, lambda: sum(len(parse_feed(data).entity) for data in feeds)))
+
+    def updates():
+        rows = 0
+        for message in messages:
+            rows += count(run.iter_updates(message, gtfs_map, set()))
+        return rows
+    stages["iter_updates"] = stage_result(*best_of(repeat, updates))
+
+    # the updates run first to fill used_trips, as in run.collect()
+    def scheduled():
+        rows = 0
+        for message in messages:
+            used_trips = set()
+            for prediction in run.iter_updates(message, gtfs_map, used_trips):
+                pass
+            rows += count(run.iter_scheduled(datetime.fromtimestamp(message.header.timestamp), gtfs_map, used_trips))
+        return rows
+    stages["iter_scheduled"] = stage_result(*best_of(repeat, scheduled))
+
+    predictions = [(date, list(run.iter_predictions(message, gtfs_map, True))) for date, message in zip(DATES, messages)]
+    store_path = os.path.join(directory, "predictions.db")
+    def write_predictions():
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(store_path + suffix):
+                os.remove(store_path + suffix)
+        store = PredictionsStore(store_path)
+        rows = 0
+        for date, batch in predictions:
+            rows += len(batch)
+            store.add_predictions(batch, date)
+            store.commit()
+        return rows
+    stages["store_write"] = stage_result(*best_of(repeat, write_predictions))
+    return stages
+
+# the stages which got slower or bigger than baseline allows, as messages
+def compare(results, baseline, tolerance):
+    regressions = []
+    for stage, result in sorted(results["stages"].items()):
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        for measurement in ("seconds", "peak_rss_kb"):
+            if result[measurement] > base[measurement] * (1 + tolerance) and \
+               result[measurement] - base[measurement] > MIN_DIFFERENCE[measurement]:
+                regressions.append("%s %s: %.3f, baseline %.3f (+%.0f%%)" % (stage, measurement, result[measurement], base[measurement],
+                                                                            100.0 * (result[measurement] / base[measurement] - 1)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the collector's stages against synthetic GTFS and GTFS-realtime feeds, and compare with a stored baseline")
+    parser.add_argument("--routes", type=int, default=20)
+    parser.add_argument("--trips-per-route", type=int, default=200)
+    parser.add_argument("--stops-per-trip", type=int, default=30)
+    parser.add_argument("--calendar", choices=sorted(CALENDAR_PATTERNS), default="weekly")
+    parser.add_argument("--holidays", type=int, default=1)
+    parser.add_argument("--updated", type=float, default=0.3, help="Share of scheduled trips with a realtime update")
+    parser.add_argument("--delayed", type=float, default=0.5, help="Share of updates given as delays rather than arrival times")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--save", help="Write this run's results here, to use as a baseline later")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    config = {"routes": args.routes, "trips_per_route": args.trips_per_route, "stops_per_trip": args.stops_per_trip,
+              "calendar": args.calendar, "holidays": args.holidays, "updated": args.updated, "delayed": args.delayed}
+    directory = tempfile.mkdtemp()
+    try:
+        stages = run_suite(directory, config, args.repeat)
+    finally:
+        shutil.rmtree(directory)
+    results = {"config": config, "python": sys.version.split()[0], "time": time.time(), "stages": stages}
+
+    print("%-30s %10s %12s %14s" % ("stage", "seconds", "rows/sec", "peak RSS MB"))
+    for stage, result in sorted(stages.items()):
+        print("%-30s %10.3f %12.0f %14.1f" % (stage, result["seconds"], result["rows_per_second"], result["peak_rss_kb"] / 1024.0))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved results to %s" % args.save)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            raise Exception("Baseline was run with %s, this run with %s" % (baseline["config"], config))
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            raise Exception("%d measurements regressed more than %.0f%% against %s" % (len(regressions), 100 * args.tolerance, args.baseline))
+        print("No regressions against %s" % args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import os
+import csv
+import random
+from datetime import datetime
+
+FEED_START = datetime(2015, 1, 1)
+FEED_END = datetime(2015, 12, 31)
+
+# service_id and monday..sunday flags of each service, trips are assigned to
+# them in turn so a service listed more than once gets more trips
+CALENDAR_PATTERNS = {
+    "weekly": [("weekday", "1111100")] * 3 + [("saturday", "0000010"), ("sunday", "0000001")],
+    "daily": [("daily", "1111111")],
+    "split": [("monday-thursday", "1111000")] * 3 + [("friday", "0000100"), ("saturday", "0000010"), ("sunday", "0000001")],
+}
+
+# weekday holidays, which run the sunday service instead
+HOLIDAYS = ["20150704", "20150101", "20150119", "20150216", "20150420", "20150525",
+            "20150907", "20151012", "20151111", "20151126", "20151127", "20151225"]
+
+def gtfs_time(secs):
+    return "%02d:%02d:%02d" % (secs // 3600, secs // 60 % 60, secs % 60)
+
+def _write(gtfs_path, table, header, rows):
+    with open(os.path.join(gtfs_path, table + ".txt"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+# calendar is one of CALENDAR_PATTERNS and holidays how many of HOLIDAYS get
+# calendar_dates exceptions. Returns the number of stop_times rows written.
+def write_feed(gtfs_path, routes=20, trips_per_route=200, stops_per_trip=30, seed=0, calendar="weekly", holidays=1):
+    if calendar not in CALENDAR_PATTERNS:
+        raise Exception("Unknown calendar pattern %s, expected one of %s" % (calendar, ", ".join(sorted(CALENDAR_PATTERNS))))
+    random.seed(seed)
+    if not os.path.isdir(gtfs_path):
+        os.makedirs(gtfs_path)
+
+    start_date = FEED_START.strftime("%Y%m%d")
+    end_date = FEED_END.strftime("%Y%m%d")
+    services = [service_id for service_id, days in CALENDAR_PATTERNS[calendar]]
+    patterns = dict(CALENDAR_PATTERNS[calendar])
+    _write(gtfs_path, "calendar",
+           ["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday", "start_date", "end_date"],
+           [[service_id] + [int(day) for day in days] + [start_date, end_date] for service_id, days in sorted(patterns.items())])
+
+    exceptions = []
+    for holiday in HOLIDAYS[:holidays]:
+        weekday = datetime.strptime(holiday, "%Y%m%d").weekday()
+        for service_id, days in sorted(patterns.items()):
+            if days[weekday] == "1" and days[6] == "0":
+                exceptions.append([service_id, holiday, 2])
+            elif days[weekday] == "0" and days[6] == "1":
+                exceptions.append([service_id, holiday, 1])
+    _write(gtfs_path, "calendar_dates", ["service_id", "date", "exception_type"], exceptions)
+    _write(gtfs_path, "routes", ["route_id", "route_short_name", "route_long_name", "route_type"],
+           [["route-%d" % route, str(route), "Route %d" % route, 3] for route in range(routes)])
+
+    stops = []
+    shapes = []
+    for route in range(routes):
+        for stop in range(stops_per_trip):
+            lat = 42.2 + route * 0.01 + stop * 0.002
+            lon = -71.2 + stop * 0.002
+            stops.append(["stop-%d-%d" % (route, stop), "Stop %d-%d" % (route, stop), "%.6f" % lat, "%.6f" % lon])
+            shapes.append(["shape-%d" % route, "%.6f" % lat, "%.6f" % lon, stop])
+    _write(gtfs_path, "stops", ["stop_id", "stop_name", "stop_lat", "stop_lon"], stops)
+    _write(gtfs_path, "shapes", ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"], shapes)
+
+    with open(os.path.join(gtfs_path, "trips.txt"), "w") as trips_file, \
+         open(os.path.join(gtfs_path, "stop_times.txt"), "w") as stop_times_file:
+        trips = csv.writer(trips_file)
+        stop_times = csv.writer(stop_times_file)
+        trips.writerow(["route_id", "service_id", "trip_id", "trip_headsign", "direction_id", "shape_id"])
+        stop_times.writerow(["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence", "pickup_type", "drop_off_type"])
+        for route in range(routes):
+            for trip in range(trips_per_route):
+                trip_id = "trip-%d-%d" % (route, trip)
+                trips.writerow(["route-%d" % route, services[trip % len(services)], trip_id, "Route %d" % route, 0, "shape-%d" % route])
+                # first departures at 5am, last ones running past midnight
+                secs = 5 * 3600 + random.randint(0, 20 * 3600)
+                for stop in range(stops_per_trip):
+                    time = gtfs_time(secs)
+                    stop_times.writerow([trip_id, time, time, "stop-%d-%d" % (route, stop), stop + 1, 0, 0])
+                    secs += random.randint(60, 180)
+
+    return routes * trips_per_route * stops_per_trip
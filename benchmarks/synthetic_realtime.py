@@ -0,0 +1,78 @@
+import os
+import csv
+import time
+import random
+
+import gtfs_realtime_pb2
+from stop_times_index import seconds_since_midnight, SECONDS_PER_DAY
+
+# stop_id -> (lat, lon) from a feed's stops.txt
+def read_stops(gtfs_path):
+    with open(os.path.join(gtfs_path, "stops.txt")) as f:
+        return dict((row["stop_id"], (float(row["stop_lat"]), float(row["stop_lon"]))) for row in csv.DictReader(f))
+
+def _feed_message(date):
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = "1.0"
+    message.header.timestamp = int(time.mktime(date.timetuple()))
+    return message
+
+# TripUpdates and VehiclePositions FeedMessages matching the schedule of a
+# GtfsMap at date. updated is the share of trips scheduled around date which
+# get an update, covering the rest of the trip's stops in the window; of
+# those, delayed is the share given as a delay rather than arrival times.
+# Each updated trip's vehicle is at its next stop.
+def realtime_feeds(gtfs_map, stops, date, updated=0.3, delayed=0.5, seed=0):
+    random.seed(seed)
+    now = seconds_since_midnight(date)
+    timestamp = int(time.mktime(date.timetuple()))
+
+    trips = {}
+    for row in gtfs_map.find_stop_times_for_datetime(date):
+        seconds_until = row["arrival_secs"] + row["day_offset"] * SECONDS_PER_DAY - now
+        if seconds_until > 0:
+            trips.setdefault(row["trip_id"], []).append((row["stop_sequence"], row["stop_id"], seconds_until))
+
+    trip_updates = _feed_message(date)
+    vehicle_positions = _feed_message(date)
+    for trip_id in sorted(trips):
+        if random.random() >= updated:
+            continue
+        upcoming = sorted(trips[trip_id])
+        delay = random.randint(-60, 600)
+        use_delay = random.random() < delayed
+
+        entity = trip_updates.entity.add()
+        entity.id = trip_id
+        entity.trip_update.trip.trip_id = trip_id
+        for stop_sequence, stop_id, seconds_until in upcoming:
+            stop_time_update = entity.trip_update.stop_time_update.add()
+            stop_time_update.stop_sequence = stop_sequence
+            stop_time_update.stop_id = stop_id
+            if use_delay:
+                stop_time_update.arrival.delay = delay
+            else:
+                stop_time_update.arrival.time = timestamp + seconds_until + delay
+
+        stop_sequence, stop_id, seconds_until = upcoming[0]
+        lat, lon = stops[stop_id]
+        entity = vehicle_positions.entity.add()
+        entity.id = trip_id
+        entity.vehicle.trip.trip_id = trip_id
+        entity.vehicle.stop_id = stop_id
+        entity.vehicle.current_stop_sequence = stop_sequence
+        entity.vehicle.position.latitude = lat
+        entity.vehicle.position.longitude = lon
+        entity.vehicle.timestamp = timestamp
+    return trip_updates, vehicle_positions
+
+# writes <feed name>.pb for each of run.FEEDS into pb_dir, alerts empty, as
+# served by bench_fetch.py
+def write_realtime(pb_dir, gtfs_map, stops, date, updated=0.3, delayed=0.5, seed=0):
+    if not os.path.isdir(pb_dir):
+        os.makedirs(pb_dir)
+    trip_updates, vehicle_positions = realtime_feeds(gtfs_map, stops, date, updated, delayed, seed)
+    for name, message in [("trip_updates", trip_updates), ("vehicle_positions", vehicle_positions), ("alerts", _feed_message(date))]:
+        with open(os.path.join(pb_dir, name + ".pb"), "wb") as f:
+            f.write(message.SerializeToString())
+    return trip_updates, vehicle_positions
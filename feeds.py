@@ -0,0 +1,163 @@
+import time
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+import gtfs_realtime_pb2
+from wire import feed_header_timestamp
+
+# message is None when unchanged is set, either because the server answered
+# 304 or because the header timestamp matches the last processed feed, and for
+# feeds the fetcher was told to leave unparsed. A feed which couldn't be
+# fetched or parsed has its error set and counts as unchanged.
+FeedResult = namedtuple('FeedResult', ['name', 'data', 'message', 'elapsed', 'timestamp', 'unchanged', 'validators', 'error'],
+                        defaults=[None])
+
+FETCH_MODES = ["serial", "threads", "asyncio"]
+
+DEFAULT_TIMEOUT = 20
+
+def parse_feed(data):
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(data)
+    return message
+
+# Fetches and parses every configured feed each cycle. Connections are kept
+# alive between cycles, and in the threads and asyncio modes all feeds are in
+# flight at once so one feed is parsed while the others are still downloading.
+# Feeds are requested conditionally and not parsed again until they change;
+# call mark_processed() once the results of fetch_all() have been stored.
+# A failure in one of the required feeds is raised from fetch_all(), any
+# other feed which fails is returned as a FeedResult with its error set so
+# the rest of the cycle goes ahead.
+class FeedFetcher(object):
+    def __init__(self, urls, mode="threads", timeouts=None, unparsed=(), required=()):
+        if mode not in FETCH_MODES:
+            raise Exception("Unknown fetch mode %s, expected one of %s" % (mode, ", ".join(FETCH_MODES)))
+        self.urls = urls
+        self.mode = mode
+        self.timeouts = timeouts or {}
+        self.unparsed = set(unparsed)
+        self.required = set(required)
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(urls), pool_maxsize=len(urls))
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=len(urls))
+
+        self._loop = None
+        self._aiohttp_session = None
+
+        self._validators = {}
+        self._timestamps = {}
+        self._pending = {}
+
+    def timeout(self, name):
+        return self.timeouts.get(name, DEFAULT_TIMEOUT)
+
+    def _request_headers(self, name):
+        etag, last_modified = self._validators.get(name, (None, None))
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def _unparsed_result(self, name, status, headers, data, start):
+        elapsed = time.time() - start
+        if status == 304:
+            return FeedResult(name=name, data=None, message=None, elapsed=elapsed, timestamp=self._timestamps.get(name),
+                              unchanged=True, validators=self._validators.get(name))
+
+        validators = (headers.get("ETag"), headers.get("Last-Modified"))
+        timestamp = feed_header_timestamp(data)
+        unchanged = timestamp is not None and timestamp == self._timestamps.get(name)
+        return FeedResult(name=name, data=data, message=None, elapsed=elapsed, timestamp=timestamp,
+                          unchanged=unchanged, validators=validators)
+
+    # stands in for the result of a feed which failed, keeping the validators
+    # and timestamp of the last one processed
+    def _failed_result(self, name, error, start):
+        if name in self.required:
+            raise error
+        return FeedResult(name=name, data=None, message=None, elapsed=time.time() - start, timestamp=self._timestamps.get(name),
+                          unchanged=True, validators=self._validators.get(name), error="%s: %s" % (type(error).__name__, error))
+
+    def _fetch_or_fail(self, name, url):
+        start = time.time()
+        try:
+            return self._fetch(name, url)
+        except Exception as e:
+            return self._failed_result(name, e, start)
+
+    def _fetch(self, name, url):
+        start = time.time()
+        response = self._session.get(url, headers=self._request_headers(name), timeout=self.timeout(name))
+        response.raise_for_status()
+        result = self._unparsed_result(name, response.status_code, response.headers, response.content, start)
+        if result.unchanged or name in self.unparsed:
+            return result
+        return result._replace(message=parse_feed(result.data), elapsed=time.time() - start)
+
+    def fetch_all(self):
+        if self.mode == "serial":
+            results = dict((name, self._fetch_or_fail(name, url)) for name, url in self.urls.items())
+        elif self.mode == "threads":
+            futures = [(name, self._executor.submit(self._fetch_or_fail, name, url)) for name, url in self.urls.items()]
+            results = dict((name, future.result()) for name, future in futures)
+        else:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+            results = self._loop.run_until_complete(self._fetch_all_async())
+        self._pending = results
+        return results
+
+    def mark_processed(self):
+        for name, result in self._pending.items():
+            self._validators[name] = result.validators
+            self._timestamps[name] = result.timestamp
+        self._pending = {}
+
+    async def _fetch_all_async(self):
+        try:
+            import aiohttp
+        except ImportError:
+            raise Exception("The asyncio fetch mode requires aiohttp")
+
+        if self._aiohttp_session is None:
+            self._aiohttp_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=len(self.urls)))
+
+        async def fetch(name, url):
+            start = time.time()
+            try:
+                return await fetch_feed(name, url, start)
+            except Exception as e:
+                return self._failed_result(name, e, start)
+
+        async def fetch_feed(name, url, start):
+            timeout = aiohttp.ClientTimeout(total=self.timeout(name))
+            async with self._aiohttp_session.get(url, headers=self._request_headers(name), timeout=timeout) as response:
+                response.raise_for_status()
+                data = await response.read()
+                result = self._unparsed_result(name, response.status, response.headers, data, start)
+            if result.unchanged or name in self.unparsed:
+                return result
+            # parsing is CPU bound, keep it off the event loop
+            message = await asyncio.get_event_loop().run_in_executor(self._executor, parse_feed, data)
+            return result._replace(message=message, elapsed=time.time() - start)
+
+        names = list(self.urls.keys())
+        results = await asyncio.gather(*[fetch(name, self.urls[name]) for name in names])
+        return dict(zip(names, results))
+
+    def close(self):
+        self._session.close()
+        if self._aiohttp_session is not None:
+            self._loop.run_until_complete(self._aiohttp_session.close())
+        if self._loop is not None:
+            self._loop.close()
+        self._executor.shutdown()
@@ -1,144 +1,467 @@
 import os
+import sys
 import csv
 from datetime import datetime, timedelta
 import sqlite3
-from collections import namedtuple
+import time
+import hashlib
+import itertools
+import threading
+from array import array
+from collections import namedtuple, OrderedDict
+from stop_times_index import StopTimesIndex, ServiceDaySchedule, parse_gtfs_seconds, seconds_since_midnight, SECONDS_PER_DAY, WINDOW_SECONDS, WEEKDAYS
+from spatial_index import SpatialIndex
+from metrics import NULL_METRICS
 
 Prediction = namedtuple('Prediction', ['stop_id', 'trip_id', 'estimated_minutes'])
-Location = namedtuple('Location', ['trip_id', 'lat', 'lon', 'stop_id'])
+# delay is seconds behind schedule, from adherence.py, None when unknown.
+# timestamp is the POSIX time the vehicle reported its position, None when the
+# feed left it out.
+Location = namedtuple('Location', ['trip_id', 'lat', 'lon', 'stop_id', 'delay', 'timestamp'], defaults=[None, None])
+
+# columns computed while importing, as (column, source column, conversion)
+DERIVED_COLUMNS = {"stop_times": [("arrival_secs", "arrival_time", parse_gtfs_seconds),
+                                  ("departure_secs", "departure_time", parse_gtfs_seconds)]}
+
+# GTFS tables in import order, with column types
+TABLES = [
+    ("trips", {"route_id" : "TEXT",
+               "service_id" : "TEXT",
+               "trip_id" : "TEXT PRIMARY KEY",
+               "trip_headsign": "TEXT",
+               "trip_short_name" : "TEXT",
+               "direction_id" : "INTEGER",
+               "block_id" : "TEXT",
+               "shape_id" : "TEXT"}),
+    ("stops", {"stop_id": "TEXT PRIMARY KEY",
+               "stop_code": "TEXT",
+               "stop_name": "TEXT",
+               "stop_desc": "TEXT",
+               "stop_lat": "TEXT",
+               "stop_lon": "TEXT",
+               "zone_id": "TEXT",
+               "stop_url": "TEXT",
+               "location_type": "INTEGER",
+               "parent_station": "TEXT"}),
+    ("routes", {"route_id": "TEXT PRIMARY KEY",
+                "agency_id": "TEXT",
+                "route_short_name": "TEXT",
+                "route_long_name": "TEXT",
+                "route_desc": "TEXT",
+                "route_type": "INTEGER",
+                "route_url": "TEXT",
+                "route_color": "TEXT",
+                "route_text_color": "TEXT"}),
+    ("stop_times", {"trip_id": "TEXT",
+                    "arrival_time": "TEXT",
+                    "departure_time": "TEXT",
+                    "stop_id": "TEXT",
+                    "stop_sequence": "INTEGER",
+                    "stop_headsign": "TEXT",
+                    "pickup_type": "INTEGER",
+                    "drop_off_type": "INTEGER",
+                    "arrival_secs": "INTEGER",
+                    "departure_secs": "INTEGER"}),
+    ("shapes", {"shape_id": "TEXT",
+                "shape_pt_lat": "TEXT",
+                "shape_pt_lon": "TEXT",
+                "shape_pt_sequence": "INTEGER",
+                "shape_dist_traveled": "TEXT"}),
+    ("calendar", {"service_id" : "TEXT",
+                  "monday" : "INTEGER",
+                  "tuesday" : "INTEGER",
+                  "wednesday" : "INTEGER",
+                  "thursday" : "INTEGER",
+                  "friday" : "INTEGER",
+                  "saturday" : "INTEGER",
+                  "sunday" : "INTEGER",
+                  "start_date" : "TEXT",
+                  "end_date" : "TEXT"}),
+    ("calendar_dates", {"service_id" : "TEXT",
+                        "date" : "TEXT",
+                        "exception_type" : "INTEGER"}),
+]
+
+# a tuple is a composite index
+TABLE_INDEXES = {"trips": ["shape_id", "route_id", "service_id"],
+                 "stop_times": ["stop_id", ("trip_id", "stop_sequence"), "arrival_secs", "departure_secs"],
+                 "shapes": ["shape_id"]}
+
+# pragmas for a bulk load; the page size only takes effect on a new database
+BULK_LOAD_PRAGMAS = [("page_size", 8192),
+                     ("journal_mode", "OFF"),
+                     ("synchronous", "OFF"),
+                     ("cache_size", -256000),
+                     ("temp_store", "MEMORY")]
+
+# trips whose stop_times are kept for find_stop_times_by_trip()
+DEFAULT_TRIP_CACHE_SIZE = 5000
+# how long before midnight to start building the next day's schedule
+SCHEDULE_PREFETCH_SECONDS = 30 * 60
+# bound parameters per IN (...) query, under SQLITE_MAX_VARIABLE_NUMBER
+QUERY_CHUNK_SIZE = 500
+# TripStopTimes.arrival_secs of a stop time without an arrival_time
+NO_ARRIVAL = -1
+
+# (date, service_id) for each day a service runs, from calendar with the
+# calendar_dates additions and removals applied
+def active_service_days(calendar_rows, calendar_date_rows):
+    active = set()
+    for row in calendar_rows:
+        days = [int(row[day] or 0) for day in WEEKDAYS]
+        date = datetime.strptime(row["start_date"], "%Y%m%d")
+        end_date = datetime.strptime(row["end_date"], "%Y%m%d")
+        while date <= end_date:
+            if days[date.weekday()]:
+                active.add((date.strftime("%Y%m%d"), row["service_id"]))
+            date += timedelta(1)
+    for row in calendar_date_rows:
+        key = (row["date"], row["service_id"])
+        if int(row["exception_type"]) == 1:
+            active.add(key)
+        elif int(row["exception_type"]) == 2:
+            active.discard(key)
+    return active
+
+def _index_columns(columns):
+    if isinstance(columns, str):
+        return (columns,)
+    return tuple(columns)
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+def _file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# One trip's stop_times in stop_sequence order, as parallel arrays of only
+# what realtime updates are matched with, so a cache of thousands of trips
+# stays a few MB. stop_id strings are interned and shared between trips.
+class TripStopTimes(object):
+    __slots__ = ("stop_sequences", "stop_ids", "arrival_secs")
+
+    def __init__(self):
+        self.stop_sequences = array('i')
+        self.stop_ids = []
+        self.arrival_secs = array('i')
+
+    def append(self, stop_sequence, stop_id, arrival_secs):
+        self.stop_sequences.append(stop_sequence)
+        self.stop_ids.append(sys.intern(stop_id))
+        self.arrival_secs.append(NO_ARRIVAL if arrival_secs is None else arrival_secs)
+
+    def __len__(self):
+        return len(self.stop_sequences)
+
+    # (stop_sequence, stop_id, arrival_secs), arrival_secs None when missing
+    def __iter__(self):
+        for stop_sequence, stop_id, arrival_secs in zip(self.stop_sequences, self.stop_ids, self.arrival_secs):
+            yield stop_sequence, stop_id, None if arrival_secs == NO_ARRIVAL else arrival_secs
 
 class GtfsMap(object):
-    def __init__(self, gtfs_path, reinitialize=True, skip_stop_times=False):
-        self._db = sqlite3.connect("./temp_gtfs.db")
+    def __init__(self, gtfs_path, reinitialize=True, skip_stop_times=False, in_memory=False, bulk_load=False, db_path="./temp_gtfs.db",
+                 trip_cache_size=DEFAULT_TRIP_CACHE_SIZE, cache_schedules=False, metrics=NULL_METRICS, spatial=False):
+        self.metrics = metrics
+        self._db_path = db_path
+        self._db = sqlite3.connect(db_path)
         self._db.row_factory = sqlite3.Row
 
 
+        self.last_date = self._read_last_date(gtfs_path)
+
+        if reinitialize:
+            self._initialize_tables(gtfs_path, skip_stop_times, bulk_load)
+        elif not skip_stop_times:
+            self._ensure_derived_columns("stop_times")
+            self._ensure_indexes("stop_times")
+        if not reinitialize:
+            self._ensure_active_services()
+        # lets refresh() swap tables underneath readers on other connections
+        self._db.execute("PRAGMA journal_mode = WAL")
+
+        self._stop_times_index = None
+        if in_memory:
+            self._stop_times_index = StopTimesIndex(self._db)
+        self._spatial_index = None
+        if spatial:
+            self._spatial_index = SpatialIndex(self._db)
+
+        # trip_id -> TripStopTimes, least recently used first
+        self._trip_cache = OrderedDict()
+        self._trip_cache_size = trip_cache_size
+        self.trip_cache_hits = 0
+        self.trip_cache_misses = 0
+
+        # service date string -> ServiceDaySchedule, see find_stop_times_for_datetime()
+        self._cache_schedules = cache_schedules
+        self._schedules = {}
+        self._schedules_lock = threading.Lock()
+        # bumped when refresh() drops the schedules, so a prefetch of old tables is thrown away
+        self._schedules_generation = 0
+        self._prefetch_thread = None
+        # bumped by every refresh() which changed a table, for callers keeping
+        # their own caches of the feed
+        self.feed_generation = 0
+
+    # the in-memory StopTimesIndex, or None without in_memory. Replaced on refresh()
+    @property
+    def stop_times_index(self):
+        return self._stop_times_index
+
+    # the SpatialIndex over stops and shapes, or None without spatial. Replaced on refresh()
+    @property
+    def spatial_index(self):
+        return self._spatial_index
+
+    def _read_last_date(self, gtfs_path):
         calendar_path = os.path.join(gtfs_path, "calendar.txt")
-        self.last_date = None
+        last_date = None
         with open(calendar_path) as f:
             for row in csv.DictReader(f):
                 date = datetime.strptime(row["end_date"], '%Y%m%d')
-                if self.last_date is None or self.last_date < date:
-                    self.last_date = date
+                if last_date is None or last_date < date:
+                    last_date = date
+        return last_date
+
+    def _initialize_tables(self, gtfs_path, skip_stop_times, bulk_load=False):
+        if bulk_load:
+            previous_pragmas = self._begin_bulk_load()
+
+        self._create_feed_files_table()
+        for table, types in TABLES:
+            self._drop_table(table)
+            self._create_table(gtfs_path, table, types)
+
+        deferred_indexes = []
+        for table, types in TABLES:
+            if skip_stop_times and table == "stop_times":
+                self._db.execute("DELETE FROM feed_files WHERE name = ?", (table,))
+                continue
+            path = os.path.join(gtfs_path, table + ".txt")
+            row_count = self._import_table(gtfs_path, table)
+            self._record_feed_file(table, _file_sha1(path), row_count, _file_stamp(path))
+            for column in TABLE_INDEXES.get(table, []):
+                if bulk_load:
+                    deferred_indexes.append((table, column))
+                else:
+                    self._create_index(table, column)
 
-        if not reinitialize:
+        for table, column in deferred_indexes:
+            self._create_index(table, column)
+        self._build_active_services()
+
+        if bulk_load:
+            self._end_bulk_load(previous_pragmas)
+        else:
+            self._db.commit()
+
+    def _begin_bulk_load(self):
+        self._db.commit()
+        previous_pragmas = []
+        for pragma, value in BULK_LOAD_PRAGMAS:
+            previous_pragmas.append((pragma, self._db.execute("PRAGMA %s" % pragma).fetchone()[0]))
+            self._db.execute("PRAGMA %s = %s" % (pragma, value))
+        self._db.isolation_level = None
+        self._db.execute("BEGIN")
+        return previous_pragmas
+
+    def _end_bulk_load(self, previous_pragmas):
+        self._db.execute("COMMIT")
+        self._db.isolation_level = ""
+        for pragma, value in previous_pragmas:
+            if pragma != "page_size":
+                self._db.execute("PRAGMA %s = %s" % (pragma, value))
+
+    # Which services run on each date of the feed, so queries for a date join
+    # against a few rows instead of testing calendar columns per stop time
+    def _build_active_services(self, calendar="calendar", calendar_dates="calendar_dates", target="active_services"):
+        self._drop_table(target)
+        self._db.execute("CREATE TABLE %s (date TEXT, service_id TEXT, PRIMARY KEY (date, service_id)) WITHOUT ROWID" % target)
+        active = active_service_days(self._db.execute("SELECT * FROM %s" % calendar),
+                                     self._db.execute("SELECT * FROM %s" % calendar_dates))
+        self._db.executemany("INSERT INTO %s (date, service_id) VALUES (?, ?)" % target, sorted(active))
+        print("Materialized %d (date, service_id) pairs into %s" % (len(active), target))
+
+    def _ensure_active_services(self):
+        if self._db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'active_services'").fetchone()[0]:
             return
+        self._build_active_services()
+        self._db.commit()
+
+    def _create_feed_files_table(self):
+        self._db.execute("CREATE TABLE IF NOT EXISTS feed_files (name TEXT PRIMARY KEY, sha1 TEXT, row_count INTEGER, size INTEGER, mtime REAL)")
+
+    def _record_feed_file(self, table, sha1, row_count, stamp):
+        size, mtime = stamp
+        self._db.execute("INSERT OR REPLACE INTO feed_files (name, sha1, row_count, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                         (table, sha1, row_count, size, mtime))
+
+    def refresh(self, gtfs_path):
+        # Safe to call from a background thread: shadow tables are built on a
+        # connection of their own while this GtfsMap keeps answering queries from
+        # the current tables. New feeds should be moved into gtfs_path whole.
+        loader = GtfsMap(gtfs_path, False, db_path=self._db_path)
+        changed = loader._refresh_tables(gtfs_path)
+        if changed:
+            self.last_date = loader.last_date
+            if self._stop_times_index is not None:
+                self._stop_times_index = StopTimesIndex(loader._db)
+            if self._spatial_index is not None and set(changed) & set(["stops", "shapes", "trips"]):
+                self._spatial_index = SpatialIndex(loader._db)
+            self._trip_cache = OrderedDict()
+            with self._schedules_lock:
+                self._schedules = {}
+                self._schedules_generation += 1
+            self.feed_generation += 1
+        del loader
+        return changed
+
+    def _refresh_tables(self, gtfs_path):
+        self._create_feed_files_table()
+        self._db.commit()
+        existing_tables = set(row["name"] for row in self._db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        feed_files = dict((row["name"], row) for row in self._db.execute("SELECT * FROM feed_files"))
+
+        shadows = []
+        for table, types in TABLES:
+            path = os.path.join(gtfs_path, table + ".txt")
+            stamp = _file_stamp(path)
+            previous = feed_files.get(table) if table in existing_tables else None
+            if previous is not None and (previous["size"], previous["mtime"]) == stamp:
+                continue
+
+            sha1 = _file_sha1(path)
+            if previous is not None and previous["sha1"] == sha1:
+                self._record_feed_file(table, sha1, previous["row_count"], stamp)
+                self._db.commit()
+                continue
+
+            print("%s changed, importing into shadow table..." % table)
+            shadow = table + "_shadow"
+            self._drop_table(shadow)
+            self._create_table(gtfs_path, table, types, target=shadow)
+            row_count = self._import_table(gtfs_path, table, target=shadow)
+            # index names are global, so tag them with the content hash
+            for column in TABLE_INDEXES.get(table, []):
+                self._create_index(shadow, column, name="idx_%s_%s_%s" % (table, "_".join(_index_columns(column)), sha1[:8]))
+            self._db.commit()
+            shadows.append((table, shadow, sha1, row_count, stamp))
+
+        if not shadows:
+            return []
+
+        changed = [table for table, shadow, sha1, row_count, stamp in shadows]
+        if "calendar" in changed or "calendar_dates" in changed:
+            self._build_active_services(calendar="calendar_shadow" if "calendar" in changed else "calendar",
+                                        calendar_dates="calendar_dates_shadow" if "calendar_dates" in changed else "calendar_dates",
+                                        target="active_services_shadow")
+            self._db.commit()
+            shadows.append(("active_services", "active_services_shadow", None, None, None))
+
+        self._db.execute("BEGIN")
+        for table, shadow, sha1, row_count, stamp in shadows:
+            self._drop_table(table)
+            self._db.execute("ALTER TABLE %s RENAME TO %s" % (shadow, table))
+            if sha1 is not None:
+                self._record_feed_file(table, sha1, row_count, stamp)
+        self._db.commit()
+        self.last_date = self._read_last_date(gtfs_path)
+        return changed
 
-        self._drop_table("trips")
-        self._create_table(gtfs_path, "trips", {"route_id" : "TEXT",
-                                                "service_id" : "TEXT",
-                                                "trip_id" : "TEXT PRIMARY KEY",
-                                                "trip_headsign": "TEXT",
-                                                "trip_short_name" : "TEXT",
-                                                "direction_id" : "INTEGER",
-                                                "block_id" : "TEXT",
-                                                "shape_id" : "TEXT"})
-        self._drop_table("stops")
-        self._create_table(gtfs_path, "stops", {"stop_id": "TEXT PRIMARY KEY",
-                                                "stop_code": "TEXT",
-                                                "stop_name": "TEXT",
-                                                "stop_desc": "TEXT",
-                                                "stop_lat": "TEXT",
-                                                "stop_lon": "TEXT",
-                                                "zone_id": "TEXT",
-                                                "stop_url": "TEXT",
-                                                "location_type": "INTEGER",
-                                                "parent_station": "TEXT"})
-        self._drop_table("routes")
-        self._create_table(gtfs_path, "routes", {"route_id": "TEXT PRIMARY KEY",
-                                                 "agency_id": "TEXT",
-                                                 "route_short_name": "TEXT",
-                                                 "route_long_name": "TEXT",
-                                                 "route_desc": "TEXT",
-                                                 "route_type": "INTEGER",
-                                                 "route_url": "TEXT",
-                                                 "route_color": "TEXT",
-                                                 "route_text_color": "TEXT"})
-        self._drop_table("stop_times")
-        self._create_table(gtfs_path, "stop_times", {"trip_id": "TEXT",
-                                                     "arrival_time": "TEXT",
-                                                     "departure_time": "TEXT",
-                                                     "stop_id": "TEXT",
-                                                     "stop_sequence": "INTEGER",
-                                                     "stop_headsign": "TEXT",
-                                                     "pickup_type": "INTEGER",
-                                                     "drop_off_type": "INTEGER"})
-        self._drop_table("shapes")
-        self._create_table(gtfs_path, "shapes", {"shape_id": "TEXT",
-                                                 "shape_pt_lat": "TEXT",
-                                                 "shape_pt_lon": "TEXT",
-                                                 "shape_pt_sequence": "INTEGER",
-                                                 "shape_dist_traveled": "TEXT"})
-        self._drop_table("calendar")
-        self._create_table(gtfs_path, "calendar", {"service_id" : "TEXT",
-                                                   "monday" : "INTEGER",
-                                                   "tuesday" : "INTEGER",
-                                                   "wednesday" : "INTEGER",
-                                                   "thursday" : "INTEGER",
-                                                   "friday" : "INTEGER",
-                                                   "saturday" : "INTEGER",
-                                                   "sunday" : "INTEGER",
-                                                   "start_date" : "TEXT",
-                                                   "end_date" : "TEXT"})
-        self._drop_table("calendar_dates")
-        self._create_table(gtfs_path, "calendar_dates", {"service_id" : "TEXT",
-                                                         "date" : "TEXT",
-                                                         "exception_type" : "INTEGER"})
-                                                   
-
-        self._import_table(gtfs_path, "trips")
-        self._create_index("trips", "shape_id")
-        self._create_index("trips", "route_id")
-        self._create_index("trips", "service_id")
-        self._import_table(gtfs_path, "stops")
-        self._import_table(gtfs_path, "routes")
-        if not skip_stop_times:
-            self._import_table(gtfs_path, "stop_times")
-            self._create_index("stop_times", "stop_id")
-            self._create_index("stop_times", "trip_id")
-            self._create_index("stop_times", "arrival_time")
-        self._import_table(gtfs_path, "shapes")
-        self._create_index("shapes", "shape_id")
-        self._import_table(gtfs_path, "calendar")
-        self._import_table(gtfs_path, "calendar_dates")
-        
-    def _import_table(self, gtfs_path, table):
+    def _import_table(self, gtfs_path, table, target=None):
+        start = time.time()
         path = os.path.join(gtfs_path, table + ".txt")
         with open(path) as f:
             reader = csv.reader(f)
             header = next(reader)
             
+            rows = reader
+            derived = DERIVED_COLUMNS.get(table, [])
+            if derived:
+                rows = self._derive_columns(reader, header, derived)
+                header = header + [column for column, source, convert in derived]
+
             joined_keys = ",".join(("'%s'" % item) for item in header)
             joined_values = ",".join("?" for item in header)
             
-            query = "INSERT INTO %s (%s) VALUES (%s)" % (table, joined_keys, joined_values)
-            self._db.executemany(query, reader)
+            query = "INSERT INTO %s (%s) VALUES (%s)" % (target or table, joined_keys, joined_values)
+            row_count = self._db.executemany(query, rows).rowcount
+
+        elapsed = time.time() - start
+        print("Imported %d rows into %s in %.2fs (%d rows/sec)" % (row_count, table, elapsed, row_count / max(elapsed, 0.001)))
+        return row_count
+
+    def _derive_columns(self, reader, header, derived):
+        conversions = [(header.index(source), convert) for column, source, convert in derived]
+        for row in reader:
+            yield row + [convert(row[index]) if row[index] else None for index, convert in conversions]
+
+    def _ensure_derived_columns(self, table):
+        existing = set(row["name"] for row in self._db.execute("PRAGMA table_info(%s)" % table))
+        if not existing:
+            return
+        for column, source, convert in DERIVED_COLUMNS.get(table, []):
+            if column in existing:
+                continue
+            print("Adding %s to %s..." % (column, table))
+            self._db.create_function("derive_%s" % column, 1, lambda value, convert=convert: convert(value) if value else None)
+            self._db.execute("ALTER TABLE %s ADD COLUMN %s INTEGER" % (table, column))
+            self._db.execute("UPDATE %s SET %s = derive_%s(%s)" % (table, column, column, source))
+            self._create_index(table, column)
+        self._db.commit()
 
     def _drop_table(self, table):
         self._db.execute("DROP TABLE IF EXISTS %s" % table)
 
 
-    def _create_table(self, gtfs_path, table, types):
+    def _create_table(self, gtfs_path, table, types, target=None):
         path = os.path.join(gtfs_path, table + ".txt")
         with open(path) as f:
             reader = csv.reader(f)
             columns = next(reader)
+            columns += [column for column, source, convert in DERIVED_COLUMNS.get(table, [])]
             
+            column_types = []
             for column in columns:
                 if column not in types:
                     print ("Type for column not found: %s" % column)
                     type = "TEXT"
                 else:
                     type = types[column]
-            joined_columns = ",".join(["%s %s" % (column, type) for column in columns])
-            self._db.execute("CREATE TABLE %s (%s)" % (table, joined_columns))
-
-
-    def _create_index(self, table, column):
-        self._db.execute("CREATE INDEX idx_%s_%s ON %s (%s)" % (table, column, table, column))
+                column_types.append((column, type))
+            joined_columns = ",".join(["%s %s" % (column, type) for column, type in column_types])
+            self._db.execute("CREATE TABLE %s (%s)" % (target or table, joined_columns))
+
+
+    def _create_index(self, table, columns, name=None):
+        columns = _index_columns(columns)
+        if name is None:
+            name = "idx_%s_%s" % (table, "_".join(columns))
+        self._db.execute("CREATE INDEX %s ON %s (%s)" % (name, table, ", ".join(columns)))
+
+    # adds indexes missing from a database built by an older version
+    def _ensure_indexes(self, table):
+        existing = set()
+        for index in self._db.execute("PRAGMA index_list(%s)" % table).fetchall():
+            existing.add(tuple(row["name"] for row in self._db.execute("PRAGMA index_info(%s)" % index["name"])))
+        if not existing:
+            return
+        for columns in TABLE_INDEXES.get(table, []):
+            if _index_columns(columns) not in existing:
+                print("Adding index on %s (%s)..." % (table, ", ".join(_index_columns(columns))))
+                self._create_index(table, columns)
+        self._db.commit()
     
+    # time spent in SQLite, executing and reading rows, goes to the sql stage
     def _query(self, query, parameters):
-        return (dict(row) for row in self._db.execute(query, parameters))
+        with self.metrics.stage("sql"):
+            cursor = self._db.execute(query, parameters)
+        return (dict(row) for row in self.metrics.timed("sql", cursor))
 
     def find_routes_by_name(self, name):
         return self._query("SELECT * FROM routes WHERE route_long_name = ? OR route_short_name = ?", (name, name))
@@ -158,73 +481,151 @@ class GtfsMap(object):
     def find_stop_times_for_stop_trip(self, stop_id, trip_id, stop_sequence):
         return self._query("SELECT s_t.* FROM stop_times s_t WHERE s_t.trip_id = ? AND s_t.stop_id = ? AND s_t.stop_sequence = ?", (trip_id, stop_id, stop_sequence))
 
+    # trip_id -> TripStopTimes for each of trip_ids, empty for unknown trips. Whole trips are read at once and kept in an LRU cache,
+    # since a trip's updates repeat from one poll to the next.
+    def find_stop_times_by_trip(self, trip_ids):
+        cache = self._trip_cache
+        trips = {}
+        missing = []
+        for trip_id in trip_ids:
+            if trip_id in trips:
+                continue
+            stop_times = cache.get(trip_id)
+            if stop_times is None:
+                missing.append(trip_id)
+                trips[trip_id] = None
+            else:
+                cache.move_to_end(trip_id)
+                trips[trip_id] = stop_times
+        hits = len(trips) - len(missing)
+
+        for start in range(0, len(missing), QUERY_CHUNK_SIZE):
+            chunk = missing[start:start + QUERY_CHUNK_SIZE]
+            loaded = dict((trip_id, TripStopTimes()) for trip_id in chunk)
+            query = ("SELECT trip_id, stop_sequence, stop_id, arrival_secs FROM stop_times WHERE trip_id IN (%s) "
+                     "ORDER BY trip_id, stop_sequence" % ",".join("?" * len(chunk)))
+            for row in self._query(query, chunk):
+                loaded[row["trip_id"]].append(int(row["stop_sequence"]), row["stop_id"], row["arrival_secs"])
+            for trip_id, stop_times in loaded.items():
+                trips[trip_id] = stop_times
+                cache[trip_id] = stop_times
+        while len(cache) > self._trip_cache_size:
+            cache.popitem(last=False)
+
+        self.trip_cache_hits += hits
+        self.trip_cache_misses += len(missing)
+        self.metrics.count("trip_cache_hits", hits)
+        self.metrics.count("trip_cache_misses", len(missing))
+        if trips:
+            print("Looked up %d trips, %d cached (%.0f%% hit rate, %.0f%% overall)" %
+                  (len(trips), hits, 100.0 * hits / len(trips),
+                   100.0 * self.trip_cache_hits / (self.trip_cache_hits + self.trip_cache_misses)))
+        return trips
+
+    # trip_id -> stop_times of the trip ordered by stop_sequence, each with its
+    # stop's stop_lat and stop_lon, for the given trips
+    def find_stop_times_for_trips(self, trip_ids):
+        trip_ids = list(trip_ids)
+        trips = dict((trip_id, []) for trip_id in trip_ids)
+        for start in range(0, len(trip_ids), QUERY_CHUNK_SIZE):
+            chunk = trip_ids[start:start + QUERY_CHUNK_SIZE]
+            query = ("SELECT s_t.*, stops.stop_lat, stops.stop_lon FROM stop_times AS s_t JOIN stops ON stops.stop_id = s_t.stop_id "
+                     "WHERE s_t.trip_id IN (%s) ORDER BY s_t.trip_id, s_t.stop_sequence" % ",".join("?" * len(chunk)))
+            for row in self._query(query, chunk):
+                trips[row["trip_id"]].append(row)
+        return trips
+
     def _stop_time_clause(self, date, after_hours):
+        now = seconds_since_midnight(date)
         if after_hours:
             date = date + timedelta(-1)
+            now += SECONDS_PER_DAY
 
-        query = ''
-        day_of_week = date.weekday()
-        if day_of_week == 0:
-            query += " monday = 1"
-        elif day_of_week == 1:
-            query += " tuesday = 1"
-        elif day_of_week == 2:
-            query += " wednesday = 1"
-        elif day_of_week == 3:
-            query += " thursday = 1"
-        elif day_of_week == 4:
-            query += " friday = 1"
-        elif day_of_week == 5:
-            query += " saturday = 1"
-        elif day_of_week == 6:
-            query += " sunday = 1"
-        
-        query += " AND start_date <= ? AND end_date >= ? AND arrival_time >= ? AND arrival_time < ? "
-
-        date_string = date.strftime("%Y%m%d")
-        arrival_time_minus_30 = date + timedelta(0, -30*60)
-        arrival_time_plus_30 = date + timedelta(0, 30*60)
-
-        def minutes_seconds(date):
-            return date.strftime("%M:%S")
-        def hours(date):
-            if after_hours:
-                hour = int(date.strftime("%H"))
-                hour += 24
-                return str(hour)
-            return date.strftime("%H")
-
-        def gtfs_time_from_date(date):
-            return "%s:%s" % (hours(date), minutes_seconds(date))
-
-        return (query, (date_string, date_string, gtfs_time_from_date(arrival_time_minus_30), gtfs_time_from_date(arrival_time_plus_30)))
-                        
+        query = " a.date = ? AND arrival_secs >= ? AND arrival_secs < ? "
+        return (query, (date.strftime("%Y%m%d"), now - WINDOW_SECONDS, now + WINDOW_SECONDS))
 
     def find_stop_times_for_datetime(self, date):
-        query = "SELECT s_t.*, route_id FROM calendar AS c JOIN trips AS t ON c.service_id = t.service_id JOIN stop_times AS s_t ON s_t.trip_id = t.trip_id "
+        if self._stop_times_index is not None:
+            return self._stop_times_index.find_stop_times_for_datetime(date)
+        if self._cache_schedules:
+            return self._find_in_schedules(date)
 
+        # day_offset is -1 for rows from yesterday's service which run past midnight
+        # CROSS JOIN keeps SQLite scanning the arrival_secs window first, rather
+        # than every stop time of the day's active trips
+        select = ("SELECT s_t.*, route_id, ? AS day_offset FROM stop_times AS s_t CROSS JOIN trips AS t ON s_t.trip_id = t.trip_id "
+                  "CROSS JOIN active_services AS a ON a.service_id = t.service_id ")
 
-        # TODO: appropriate time zone handling for times
-        # TODO: calendar_dates
 
-        parameters = ()
+        # TODO: appropriate time zone handling for times
 
-        query += " WHERE ("
         sub_query, sub_params = self._stop_time_clause(date, False)
-        query += " (" + sub_query + ") " 
-        parameters += sub_params
+        query = select + " WHERE (" + sub_query + ") "
+        parameters = (0,) + sub_params
 
-        query += " OR "
+        query += " UNION ALL "
 
         sub_query, sub_params = self._stop_time_clause(date, True)
-        query += " (" + sub_query + ") "
-        parameters += sub_params
-
-        query += " )"
+        query += select + " WHERE (" + sub_query + ") "
+        parameters += (-1,) + sub_params
 
         return self._query(query, parameters)
 
  
+    # With cache_schedules, each service day's schedule is read once and polls
+    # slide their window over it. Tomorrow's is built in the background shortly
+    # before midnight, so the first poll of the day doesn't wait for it.
+    def _find_in_schedules(self, date):
+        today = self._schedule(self._db, date)
+        yesterday = self._schedule(self._db, date + timedelta(-1))
+        with self._schedules_lock:
+            for key in [key for key in self._schedules if key < yesterday.service_date.strftime("%Y%m%d")]:
+                del self._schedules[key]
+        self._prefetch_schedule(date + timedelta(1), seconds_since_midnight(date))
+
+        now = seconds_since_midnight(date)
+        # trips belonging to yesterday's service which run past midnight have day_offset -1
+        return itertools.chain(today.rows(0, now - WINDOW_SECONDS, now + WINDOW_SECONDS),
+                               yesterday.rows(-1, now + SECONDS_PER_DAY - WINDOW_SECONDS, now + SECONDS_PER_DAY + WINDOW_SECONDS))
+
+    def _schedule(self, db, service_date):
+        key = service_date.strftime("%Y%m%d")
+        with self._schedules_lock:
+            schedule = self._schedules.get(key)
+            generation = self._schedules_generation
+        if schedule is not None:
+            self.metrics.count("schedule_cache_hits")
+            return schedule
+
+        self.metrics.count("schedule_cache_misses")
+        start = time.time()
+        schedule = ServiceDaySchedule(db, service_date)
+        print("Built schedule for %s, %d stop times in %.2fs" % (key, len(schedule), time.time() - start))
+        with self._schedules_lock:
+            if generation == self._schedules_generation:
+                self._schedules[key] = schedule
+        return schedule
+
+    def _prefetch_schedule(self, service_date, now):
+        if now < SECONDS_PER_DAY - SCHEDULE_PREFETCH_SECONDS:
+            return
+        with self._schedules_lock:
+            if service_date.strftime("%Y%m%d") in self._schedules:
+                return
+        if self._prefetch_thread is not None and self._prefetch_thread.is_alive():
+            return
+        self._prefetch_thread = threading.Thread(target=self._prefetch, args=(service_date,))
+        self._prefetch_thread.daemon = True
+        self._prefetch_thread.start()
+
+    def _prefetch(self, service_date):
+        # sqlite3 connections stay on the thread which opened them
+        db = sqlite3.connect(self._db_path)
+        try:
+            self._schedule(db, service_date)
+        finally:
+            db.close()
+
     def __del__(self):
         self._db.commit()
         self._db.close()
@@ -0,0 +1,202 @@
+import json
+import time
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# prefix of every metric on the Prometheus endpoint
+PROMETHEUS_PREFIX = "collector"
+
+class _Stage(object):
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.add_time(self._name, time.perf_counter() - self._start)
+        return False
+
+# Per-cycle wall time by stage and counters, written as one JSON object per
+# line at end_cycle(). Stages may nest, e.g. sql time is also part of the
+# schedule stage which ran the query. Counters may be bumped from other
+# threads, like a schedule prefetch, and land in the cycle they finish in.
+class Metrics(object):
+    enabled = True
+
+    def __init__(self, path=None):
+        self.path = path
+        self._file = open(path, "a") if path is not None else None
+        self._lock = threading.Lock()
+        self._seconds = {}
+        self._counts = {}
+        self._cycle_start = time.perf_counter()
+        self.cycles = 0
+        # summed over every cycle, for the Prometheus counters
+        self.totals = {}
+        # the record written by the last end_cycle()
+        self.last = None
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self._seconds[name] = self._seconds.get(name, 0) + seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    # yields from iterable, adding the time spent waiting on it to stage name.
+    # For lazy results such as SQLite cursors, whose work happens as they're read.
+    def timed(self, name, iterable):
+        iterator = iter(iterable)
+        seconds = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            self.add_time(name, seconds)
+
+    # Starts timing a cycle, so cycle_seconds leaves out any sleep since the
+    # last end_cycle()
+    def start_cycle(self):
+        self._cycle_start = time.perf_counter()
+
+    # Writes out this cycle's record, with fields added to it, and starts the
+    # next cycle, timed from here unless start_cycle() is called. A rate is added for each <name>_hits counter with a matching
+    # <name>_misses.
+    def end_cycle(self, **fields):
+        with self._lock:
+            seconds, self._seconds = self._seconds, {}
+            counts, self._counts = self._counts, {}
+        now = time.perf_counter()
+        record = {"time": time.time(), "cycle_seconds": now - self._cycle_start,
+                  "stages": seconds, "counts": counts}
+        self._cycle_start = now
+
+        rates = {}
+        for name, hits in counts.items():
+            if name.endswith("_hits"):
+                total = hits + counts.get(name[:-len("_hits")] + "_misses", 0)
+                if total:
+                    rates[name[:-len("_hits")] + "_hit_rate"] = float(hits) / total
+        record["rates"] = rates
+        record.update(fields)
+
+        with self._lock:
+            self.cycles += 1
+            for name, value in counts.items():
+                self.totals[name] = self.totals.get(name, 0) + value
+            self.last = record
+        if self._file is not None:
+            self._file.write(json.dumps(record, sort_keys=True) + "\n")
+            self._file.flush()
+        return record
+
+    # the last cycle as gauges, and the counters summed over every cycle
+    def prometheus_text(self):
+        # called from the MetricsServer thread
+        with self._lock:
+            cycles = self.cycles
+            totals = dict(self.totals)
+            record = self.last
+        lines = ["# TYPE %s_cycles_total counter" % PROMETHEUS_PREFIX,
+                 "%s_cycles_total %d" % (PROMETHEUS_PREFIX, cycles)]
+        if record is not None:
+            lines.append("# TYPE %s_cycle_seconds gauge" % PROMETHEUS_PREFIX)
+            lines.append("%s_cycle_seconds %f" % (PROMETHEUS_PREFIX, record["cycle_seconds"]))
+            lines.append("# TYPE %s_stage_seconds gauge" % PROMETHEUS_PREFIX)
+            for name, seconds in sorted(record["stages"].items()):
+                lines.append('%s_stage_seconds{stage="%s"} %f' % (PROMETHEUS_PREFIX, name, seconds))
+            for name, rate in sorted(record["rates"].items()):
+                lines.append("# TYPE %s_%s gauge" % (PROMETHEUS_PREFIX, name))
+                lines.append("%s_%s %f" % (PROMETHEUS_PREFIX, name, rate))
+            for name, value in sorted(record.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and name not in ("time", "cycle_seconds"):
+                    lines.append("# TYPE %s_%s gauge" % (PROMETHEUS_PREFIX, name))
+                    lines.append("%s_%s %s" % (PROMETHEUS_PREFIX, name, value))
+        for name, value in sorted(totals.items()):
+            lines.append("# TYPE %s_%s_total counter" % (PROMETHEUS_PREFIX, name))
+            lines.append("%s_%s_total %s" % (PROMETHEUS_PREFIX, name, value))
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+# Stands in for Metrics when instrumentation is off, so callers don't check
+class NullMetrics(object):
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def timed(self, name, iterable):
+        return iterable
+
+    def start_cycle(self):
+        pass
+
+    def end_cycle(self, **fields):
+        return None
+
+    def close(self):
+        pass
+
+NULL_METRICS = NullMetrics()
+
+# Serves metrics.prometheus_text() on /metrics from a background thread
+class MetricsServer(object):
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = HTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
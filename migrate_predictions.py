@@ -0,0 +1,21 @@
+import os
+import argparse
+
+from predictions import migrate_to_compact
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate predictions.db to the compact schema")
+    parser.add_argument("source_path")
+    parser.add_argument("target_path")
+    parser.add_argument("--without-rowid", action="store_true")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.source_path):
+        raise Exception("source_path does not exist")
+    if os.path.exists(args.target_path):
+        raise Exception("target_path already exists")
+
+    migrate_to_compact(args.source_path, args.target_path, args.without_rowid)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from feeds import parse_feed
+from wire import split_feed
+
+# more parts than workers keeps every core busy when entities vary in size
+PARTS_PER_WORKER = 4
+# parts submitted ahead of the one being read
+PENDING_PARTS_PER_WORKER = 2
+
+# The stop time updates of one FeedEntity as (trip_id, stop_id, stop_sequence,
+# arrival_time, arrival_delay, schedule_relationship), like
+# wire.scan_trip_updates(). Plain tuples, so they can be sent back from worker
+# processes.
+def scan_entity(entity):
+    updates = []
+    if entity.trip_update:
+        trip_id = entity.trip_update.trip.trip_id
+        for stop_time_update in entity.trip_update.stop_time_update:
+            arrival_time = None
+            arrival_delay = None
+            if stop_time_update.HasField("arrival"):
+                if stop_time_update.arrival.HasField("time"):
+                    arrival_time = stop_time_update.arrival.time
+                if stop_time_update.arrival.HasField("delay"):
+                    arrival_delay = stop_time_update.arrival.delay
+            updates.append((trip_id, stop_time_update.stop_id, stop_time_update.stop_sequence, arrival_time, arrival_delay,
+                            stop_time_update.schedule_relationship))
+    return updates
+
+def _scan_part(data):
+    updates = []
+    for entity in parse_feed(data).entity:
+        updates.extend(scan_entity(entity))
+    return updates
+
+# Parses a trip updates feed in worker processes. The feed is split into
+# FeedMessages of a few entities each, which the workers decode and scan; the
+# schedule isn't available to them, so the updates are matched against it
+# afterwards.
+class UpdatesPool(object):
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(self.processes)
+
+    # Yields scan_entity() over the whole feed, in feed order. Parts are handed
+    # out as the caller reads, so only the updates of the parts in flight are
+    # held at once rather than the whole feed's.
+    def scan(self, data):
+        pending = deque()
+        for part in split_feed(data, self.processes * PARTS_PER_WORKER):
+            pending.append(self._executor.submit(_scan_part, part))
+            if len(pending) >= self.processes * PENDING_PARTS_PER_WORKER:
+                for update in pending.popleft().result():
+                    yield update
+        while pending:
+            for update in pending.popleft().result():
+                yield update
+
+    def close(self):
+        self._executor.shutdown()
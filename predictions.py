@@ -1,28 +1,475 @@
+import os
+import re
+import csv
+import gzip
 import sqlite3
+import time
+import itertools
 
 from gtfs_map import Prediction, Location
+from alerts import AlertIndex
+from metrics import NULL_METRICS
 import datetime
 import calendar
 
+INSERT_PREDICTION = "INSERT INTO predictions (stop_id, trip_id, estimate_minutes, created_at) VALUES (?, ?, ?, ?)"
+INSERT_LOCATION = "INSERT INTO locations (trip_id, lat, lon, stop_id, delay, created_at) VALUES(?, ?, ?, ?, ?, ?)"
+INSERT_COMPACT_PREDICTION = "INSERT INTO compact_predictions (created_at, stop_key, trip_key, estimate_minutes) VALUES (?, ?, ?, ?)"
+UPSERT_COMPACT_PREDICTION = (INSERT_COMPACT_PREDICTION + " ON CONFLICT (created_at, stop_key, trip_key) "
+                             "DO UPDATE SET estimate_minutes = MIN(estimate_minutes, excluded.estimate_minutes)")
+
+SELECT_PREDICTIONS = "SELECT created_at, stop_id, trip_id, estimate_minutes FROM predictions WHERE created_at >= ? AND created_at < ? ORDER BY created_at"
+SELECT_COMPACT_PREDICTIONS = "SELECT created_at, stop_key, trip_key, estimate_minutes FROM compact_predictions WHERE created_at >= ? AND created_at < ? ORDER BY created_at"
+
+INSERT_ALERT = ("INSERT OR IGNORE INTO alerts (alert_hash, alert_id, cause, effect, header_text, description_text, url, first_seen, last_seen) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+INSERT_ALERT_PERIOD = "INSERT INTO alert_periods (alert_hash, start_time, end_time) VALUES (?, ?, ?)"
+INSERT_ALERT_ENTITY = "INSERT INTO alert_entities (alert_hash, agency_id, route_id, route_type, trip_id, stop_id) VALUES (?, ?, ?, ?, ?, ?)"
+UPDATE_ALERT_LAST_SEEN = "UPDATE alerts SET last_seen = ? WHERE alert_hash = ?"
+
+DEFAULT_KEYFRAME_INTERVAL = 60
+
+# service days run past midnight, so partitions roll over at 3am
+ROLLOVER_HOUR = 3
+PARTITION_NAME = re.compile(r"^predictions-(\d{8})\.db$")
+
+# stop and trip ids are interned into these tables in the compact format
+KEY_TABLES = {"stop": "stop_keys", "trip": "trip_keys"}
+
 def make_timestamp(date):
     return calendar.timegm(date.utctimetuple())
+
+def service_date(date):
+    return (date - datetime.timedelta(0, ROLLOVER_HOUR * 60 * 60)).date()
+
+def partition_path(partition_dir, date):
+    return os.path.join(partition_dir, "predictions-%s.db" % date.strftime("%Y%m%d"))
+
+# (service date, path) for each partition in partition_dir, oldest first
+def list_partitions(partition_dir):
+    partitions = []
+    for name in os.listdir(partition_dir):
+        match = PARTITION_NAME.match(name)
+        if match:
+            date = datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+            partitions.append((date, os.path.join(partition_dir, name)))
+    return sorted(partitions)
+
+def _is_compact(db):
+    return db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'compact_predictions'").fetchone()[0] > 0
+
+# yields (created_at, Prediction) from one database, oldest first
+def _iter_predictions(db, compact, start, end):
+    parameters = (start, end)
+    if not compact:
+        for created_at, stop_id, trip_id, estimate_minutes in db.execute(SELECT_PREDICTIONS, parameters):
+            yield created_at, Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=estimate_minutes)
+        return
+
+    stop_ids = dict(db.execute("SELECT stop_key, stop_id FROM stop_keys").fetchall())
+    trip_ids = dict(db.execute("SELECT trip_key, trip_id FROM trip_keys").fetchall())
+    for created_at, stop_key, trip_key, estimate_minutes in db.execute(SELECT_COMPACT_PREDICTIONS, parameters):
+        yield created_at, Prediction(stop_id=stop_ids[stop_key], trip_id=trip_ids[trip_key], estimated_minutes=estimate_minutes)
+
+# the full list of predictions as of the last delta snapshot at or before
+# timestamp, or None if this database has no snapshot that early
+def _rebuild_snapshot(db, compact, timestamp):
+    snapshot_time = db.execute("SELECT MAX(created_at) FROM snapshots WHERE created_at <= ?", (timestamp,)).fetchone()[0]
+    if snapshot_time is None:
+        return None
+    keyframe_time = db.execute("SELECT MAX(created_at) FROM snapshots WHERE keyframe = 1 AND created_at <= ?",
+                               (snapshot_time,)).fetchone()[0]
+    if keyframe_time is None:
+        keyframe_time = db.execute("SELECT MIN(created_at) FROM snapshots").fetchone()[0]
+
+    state = {}
+    for created_at, prediction in _iter_predictions(db, compact, keyframe_time, snapshot_time + 1):
+        key = (prediction.stop_id, prediction.trip_id)
+        if prediction.estimated_minutes is None:
+            state.pop(key, None)
+        else:
+            state[key] = (prediction.estimated_minutes, created_at)
+    return [Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=minutes - (snapshot_time - created_at) // 60)
+            for (stop_id, trip_id), (minutes, created_at) in state.items()]
+
 class PredictionsStore(object):
 
-    def __init__(self):
-        self._db = sqlite3.connect("./predictions.db")
+    # compact stores predictions as integer keys into stop_keys and trip_keys,
+    # one row per stop and trip each minute, optionally clustered by
+    # (created_at, stop_key, trip_key) in a WITHOUT ROWID table.
+    #
+    # alerts are stored once per database by content hash, with the first and
+    # last time they were seen, and the entities they inform indexed by
+    # route_id, stop_id and trip_id.
+    #
+    # delta only stores a prediction when it is new, disappears (stored with
+    # estimate_minutes NULL), or differs from counting down the last stored
+    # value. Every keyframe_interval snapshots, and first thing after opening
+    # the store, the whole snapshot is written out. snapshot_at() rebuilds the
+    # full set of predictions for any time.
+    #
+    # partition_dir writes one database per service date into that directory
+    # instead of path, switching files when the date rolls over. Reads fan out
+    # over the partitions a time range touches.
+    def __init__(self, path="./predictions.db", compact=False, without_rowid=False, delta=False, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+                 partition_dir=None, metrics=NULL_METRICS):
+        self.metrics = metrics
+        self.compact = compact
+        self.without_rowid = without_rowid
+        self.delta = delta
+        if delta:
+            self._keyframe_interval = keyframe_interval
+            self._since_keyframe = None
+            # (stop_id, trip_id) -> (estimate_minutes, created_at) as last stored
+            self._stored = {}
+            self._snapshot = {}
+            self._snapshot_time = None
+
+        # the alerts in the last feed added
+        self.alert_index = AlertIndex()
+
+        self._partition_dir = partition_dir
+        self._partition = None
+        self._db = None
+        if partition_dir is None:
+            self._open(path)
+        elif not os.path.isdir(partition_dir):
+            os.makedirs(partition_dir)
+
+    def _open(self, path):
+        self._db = sqlite3.connect(path)
         self._db.row_factory = sqlite3.Row
+        # WAL only needs an fsync at checkpoints, and readers don't block the collector
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+
+        if self.compact:
+            self._create_compact_tables(self.without_rowid)
+        else:
+            self._db.execute("CREATE TABLE IF NOT EXISTS predictions (stop_id TEXT, trip_id TEXT, estimate_minutes INTEGER, created_at TIMESTAMP)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_predictions_created_at ON predictions (created_at)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS locations (trip_id TEXT, lat FLOAT, lon FLOAT, stop_id TEXT, created_at TIMESTAMP, delay INTEGER)")
+        # databases from before schedule adherence
+        if "delay" not in set(row["name"] for row in self._db.execute("PRAGMA table_info(locations)")):
+            self._db.execute("ALTER TABLE locations ADD COLUMN delay INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_locations_created_at ON locations (created_at)")
+
+        self._db.execute("CREATE TABLE IF NOT EXISTS alerts (alert_hash TEXT PRIMARY KEY, alert_id TEXT, cause INTEGER, effect INTEGER, "
+                         "header_text TEXT, description_text TEXT, url TEXT, first_seen INTEGER, last_seen INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS alert_periods (alert_hash TEXT, start_time INTEGER, end_time INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_alert_periods_alert_hash ON alert_periods (alert_hash)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS alert_entities (alert_hash TEXT, agency_id TEXT, route_id TEXT, route_type INTEGER, "
+                         "trip_id TEXT, stop_id TEXT)")
+        for column in ("alert_hash", "route_id", "stop_id", "trip_id"):
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_alert_entities_%s ON alert_entities (%s)" % (column, column))
+        self._stored_alerts = set(row[0] for row in self._db.execute("SELECT alert_hash FROM alerts"))
+
+        if self.delta:
+            self._db.execute("CREATE TABLE IF NOT EXISTS snapshots (created_at INTEGER PRIMARY KEY, keyframe INTEGER)")
+            # each database starts from a keyframe so it can be read on its own
+            self._since_keyframe = None
+
+    # Switches to the partition for date. Writes arriving a little late for the
+    # previous service date stay in the current partition rather than reopening
+    # the old one; reads look one partition back to cover them.
+    def _use_partition(self, date):
+        if self._partition_dir is None:
+            return
+        date = service_date(date)
+        if self._partition is not None and date <= self._partition:
+            return
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+        print("Switching to predictions partition for %s" % date)
+        self._open(partition_path(self._partition_dir, date))
+        self._partition = date
+
+    def _read_databases(self, start, end):
+        if self._partition_dir is None:
+            yield self._db
+            return
+        first = service_date(datetime.datetime.utcfromtimestamp(start)) - datetime.timedelta(1)
+        last = service_date(datetime.datetime.utcfromtimestamp(end))
+        for date, path in list_partitions(self._partition_dir):
+            if date < first or date > last:
+                continue
+            if date == self._partition:
+                yield self._db
+                continue
+            db = sqlite3.connect(path)
+            try:
+                yield db
+            finally:
+                db.close()
+
+    def _create_compact_tables(self, without_rowid):
+        self._keys = {}
+        for kind, table in KEY_TABLES.items():
+            self._db.execute("CREATE TABLE IF NOT EXISTS %s (%s_key INTEGER PRIMARY KEY, %s_id TEXT UNIQUE)" % (table, kind, kind))
+            self._keys[kind] = dict((row[1], row[0]) for row in self._db.execute("SELECT %s_key, %s_id FROM %s" % (kind, kind, table)))
+
+        # predictions for the same stop and trip written in separate batches of
+        # one snapshot, such as the updates and the schedule, are merged to the
+        # earliest in either layout
+        if without_rowid:
+            self._db.execute("CREATE TABLE IF NOT EXISTS compact_predictions (created_at INTEGER NOT NULL, stop_key INTEGER NOT NULL, "
+                             "trip_key INTEGER NOT NULL, estimate_minutes INTEGER, "
+                             "PRIMARY KEY (created_at, stop_key, trip_key)) WITHOUT ROWID")
+        else:
+            self._db.execute("CREATE TABLE IF NOT EXISTS compact_predictions (created_at INTEGER, stop_key INTEGER, trip_key INTEGER, estimate_minutes INTEGER)")
+            indexes = set(row[1] for row in self._db.execute("PRAGMA index_list(compact_predictions)"))
+            if "idx_compact_predictions_key" not in indexes:
+                # databases from before the unique index may hold duplicates, keep the earliest
+                self._db.execute("DELETE FROM compact_predictions WHERE rowid NOT IN (SELECT rowid FROM (SELECT rowid, MIN(estimate_minutes) "
+                                 "FROM compact_predictions GROUP BY created_at, stop_key, trip_key))")
+                self._db.execute("CREATE UNIQUE INDEX idx_compact_predictions_key ON compact_predictions (created_at, stop_key, trip_key)")
+                self._db.execute("DROP INDEX IF EXISTS idx_compact_predictions_created_at")
+                self._db.commit()
 
-        self._db.execute("CREATE TABLE IF NOT EXISTS predictions (stop_id TEXT, trip_id TEXT, estimate_minutes INTEGER, created_at TIMESTAMP)")
-        self._db.execute("CREATE TABLE IF NOT EXISTS locations (trip_id TEXT, lat FLOAT, lon FLOAT, stop_id TEXT, created_at TIMESTAMP)")
+    def _key(self, kind, value):
+        keys = self._keys[kind]
+        key = keys.get(value)
+        if key is None:
+            table = KEY_TABLES[kind]
+            key = self._db.execute("INSERT INTO %s (%s_id) VALUES (?)" % (table, kind), (value,)).lastrowid
+            keys[value] = key
+        return key
+
+    def _begin(self):
+        if not self._db.in_transaction:
+            self._db.execute("BEGIN")
 
     def add_prediction(self, prediction, current_date):
+        self._use_partition(current_date)
         current_time = make_timestamp(current_date)
-        self._db.execute("INSERT INTO predictions (stop_id, trip_id, estimate_minutes, created_at) VALUES (?, ?, ?, ?)", (prediction.stop_id, prediction.trip_id, prediction.estimated_minutes, current_time))
+        if self.delta:
+            self._add_to_snapshot([prediction], current_time)
+            return
+        if self.compact:
+            self._insert_predictions([prediction], current_time)
+            return
+        self._db.execute(INSERT_PREDICTION, (prediction.stop_id, prediction.trip_id, prediction.estimated_minutes, current_time))
+
+    # Batched writes share one transaction until commit()
+    def add_predictions(self, predictions, current_date):
+        self._use_partition(current_date)
+        if self.delta:
+            return self._add_to_snapshot(predictions, make_timestamp(current_date))
+        with self.metrics.stage("insert"):
+            return self._insert_predictions(predictions, make_timestamp(current_date))
+
+    # columns is a vectorized.PredictionColumns batch
+    def add_prediction_columns(self, columns, current_date):
+        if self.delta or self.compact:
+            return self.add_predictions(map(Prediction, columns.stop_ids, columns.trip_ids, columns.estimated_minutes), current_date)
+        self._use_partition(current_date)
+        self._begin()
+        rows = zip(columns.stop_ids, columns.trip_ids, columns.estimated_minutes, itertools.repeat(make_timestamp(current_date)))
+        with self.metrics.stage("insert"):
+            count = self._db.executemany(INSERT_PREDICTION, rows).rowcount
+        self.metrics.count("prediction_rows", count)
+        return count
+
+    # a snapshot collects every add_predictions() call for one created_at and is
+    # written out on commit()
+    def _add_to_snapshot(self, predictions, created_at):
+        if self._snapshot_time is not None and self._snapshot_time != created_at:
+            self._finish_snapshot()
+        self._snapshot_time = created_at
+
+        snapshot = self._snapshot
+        count = 0
+        for prediction in predictions:
+            key = (prediction.stop_id, prediction.trip_id)
+            previous = snapshot.get(key)
+            if previous is None or prediction.estimated_minutes < previous:
+                snapshot[key] = prediction.estimated_minutes
+            count += 1
+        return count
+
+    def _finish_snapshot(self):
+        if self._snapshot_time is None:
+            return
+        created_at = self._snapshot_time
+        snapshot = self._snapshot
+
+        keyframe = self._since_keyframe is None or self._since_keyframe + 1 >= self._keyframe_interval
+        if keyframe:
+            self._stored = {}
+            self._since_keyframe = 0
+        else:
+            self._since_keyframe += 1
+        stored = self._stored
+
+        changes = []
+        for key, minutes in snapshot.items():
+            previous = stored.get(key)
+            if previous is not None:
+                previous_minutes, previous_created_at = previous
+                if previous_minutes - (created_at - previous_created_at) // 60 == minutes:
+                    continue
+            stored[key] = (minutes, created_at)
+            changes.append(Prediction(stop_id=key[0], trip_id=key[1], estimated_minutes=minutes))
+        for key in [key for key in stored if key not in snapshot]:
+            del stored[key]
+            changes.append(Prediction(stop_id=key[0], trip_id=key[1], estimated_minutes=None))
+
+        self._begin()
+        self._db.execute("INSERT OR REPLACE INTO snapshots (created_at, keyframe) VALUES (?, ?)", (created_at, int(keyframe)))
+        self._insert_predictions(changes, created_at)
+        print("Stored %d changes for %d predictions%s" % (len(changes), len(snapshot), " (keyframe)" if keyframe else ""))
+
+        self._snapshot = {}
+        self._snapshot_time = None
+
+    def _insert_predictions(self, predictions, created_at):
+        self._begin()
+        if not self.compact:
+            rows = ((prediction.stop_id, prediction.trip_id, prediction.estimated_minutes, created_at) for prediction in predictions)
+            count = self._db.executemany(INSERT_PREDICTION, rows).rowcount
+            self.metrics.count("prediction_rows", count)
+            return count
+
+        # a trip which visits a stop twice keeps only its next arrival
+        minutes = {}
+        stop_keys = self._keys["stop"]
+        trip_keys = self._keys["trip"]
+        for prediction in predictions:
+            stop_key = stop_keys.get(prediction.stop_id)
+            if stop_key is None:
+                stop_key = self._key("stop", prediction.stop_id)
+            trip_key = trip_keys.get(prediction.trip_id)
+            if trip_key is None:
+                trip_key = self._key("trip", prediction.trip_id)
+            key = (stop_key, trip_key)
+            previous = minutes.get(key)
+            if previous is None or (prediction.estimated_minutes is not None and prediction.estimated_minutes < previous):
+                minutes[key] = prediction.estimated_minutes
+        rows = ((created_at, stop_key, trip_key, estimate_minutes) for (stop_key, trip_key), estimate_minutes in minutes.items())
+        count = self._db.executemany(UPSERT_COMPACT_PREDICTION, rows).rowcount
+        self.metrics.count("prediction_rows", count)
+        return count
+
+    # yields (created_at, Prediction) for predictions made in [start_date, end_date)
+    def find_predictions(self, start_date, end_date):
+        start = make_timestamp(start_date)
+        end = make_timestamp(end_date)
+        for db in self._read_databases(start, end):
+            for row in _iter_predictions(db, self.compact, start, end):
+                yield row
+
+    # in delta mode, the full list of predictions as of the last snapshot at or before date
+    def snapshot_at(self, date):
+        timestamp = make_timestamp(date)
+        # the latest snapshot may be in the partition before date's
+        latest = []
+        for db in self._read_databases(timestamp, timestamp):
+            snapshot = _rebuild_snapshot(db, self.compact, timestamp)
+            if snapshot is not None:
+                latest = snapshot
+        return latest
 
     def commit(self):
-        self._db.commit()
+        if self._db is None:
+            return
+        if self.delta:
+            with self.metrics.stage("insert"):
+                self._finish_snapshot()
+        with self.metrics.stage("commit"):
+            self._db.commit()
 
 
     def add_location(self, location, current_date):
+        self._use_partition(current_date)
+        current_time = make_timestamp(current_date)
+        self._db.execute(INSERT_LOCATION, (location.trip_id, location.lat, location.lon, location.stop_id, location.delay, current_time))
+
+    def add_locations(self, locations, current_date):
+        self._use_partition(current_date)
+        current_time = make_timestamp(current_date)
+        self._begin()
+        rows = ((location.trip_id, location.lat, location.lon, location.stop_id, location.delay, current_time) for location in locations)
+        with self.metrics.stage("insert"):
+            count = self._db.executemany(INSERT_LOCATION, rows).rowcount
+        self.metrics.count("location_rows", count)
+        return count
+
+    # Stores the alerts in a feed snapshot, writing out only the ones not
+    # already in the database and bumping last_seen for the rest, and makes
+    # them the alert_index. Returns how many were new.
+    def add_alerts(self, alerts, current_date):
+        self._use_partition(current_date)
         current_time = make_timestamp(current_date)
-        self._db.execute("INSERT INTO locations (trip_id, lat, lon, stop_id, created_at) VALUES(?, ?, ?, ?, ?)", (location.trip_id, location.lat, location.lon, location.stop_id, current_time))
+        alerts = list(alerts)
+        new_alerts = list(dict((alert.alert_hash, alert) for alert in alerts if alert.alert_hash not in self._stored_alerts).values())
+        self._begin()
+        with self.metrics.stage("insert"):
+            self._db.executemany(INSERT_ALERT, ((alert.alert_hash, alert.alert_id, alert.cause, alert.effect, alert.header_text,
+                                                 alert.description_text, alert.url, current_time, current_time) for alert in new_alerts))
+            self._db.executemany(INSERT_ALERT_PERIOD, ((alert.alert_hash, start, end) for alert in new_alerts
+                                                       for start, end in alert.active_periods))
+            self._db.executemany(INSERT_ALERT_ENTITY, ((alert.alert_hash,) + tuple(entity) for alert in new_alerts
+                                                       for entity in alert.informed_entities))
+            self._db.executemany(UPDATE_ALERT_LAST_SEEN, ((current_time, alert.alert_hash) for alert in alerts
+                                                          if alert.alert_hash in self._stored_alerts))
+        self._stored_alerts.update(alert.alert_hash for alert in new_alerts)
+        self.metrics.count("alert_rows", len(new_alerts))
+        # active periods are POSIX times, current_date local like the feed's
+        self.alert_index = AlertIndex(alerts, int(time.mktime(current_date.timetuple())))
+        return len(new_alerts)
+
+# copies a predictions.db written in the original schema into the compact format
+def migrate_to_compact(source_path, target_path, without_rowid):
+    source = sqlite3.connect(source_path)
+    store = PredictionsStore(target_path, compact=True, without_rowid=without_rowid)
+
+    count = 0
+    rows = source.execute("SELECT created_at, stop_id, trip_id, estimate_minutes FROM predictions ORDER BY created_at")
+    for created_at, group in itertools.groupby(rows, key=lambda row: row[0]):
+        predictions = [Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=estimate_minutes)
+                       for created_at, stop_id, trip_id, estimate_minutes in group]
+        store._insert_predictions(predictions, created_at)
+        count += len(predictions)
+        if count % 1000000 < len(predictions):
+            print("Migrated %d predictions..." % count)
+            store.commit()
+    store.commit()
+
+    print("Copying locations...")
+    store._db.execute("ATTACH DATABASE ? AS source", (source_path,))
+    columns = "trip_id, lat, lon, stop_id, created_at"
+    if "delay" in set(row[1] for row in source.execute("PRAGMA table_info(locations)")):
+        columns += ", delay"
+    store._db.execute("INSERT INTO locations (%s) SELECT %s FROM source.locations" % (columns, columns))
+    store.commit()
+    store._db.execute("DETACH DATABASE source")
+
+    print("Migrated %d predictions" % count)
+
+# Partitions other than the one being written can be compacted or exported
+# while the collector keeps running, they are never opened for writing again.
+def compact_partition(path):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.execute("PRAGMA journal_mode = DELETE")
+    compacted_path = path + ".compacting"
+    if os.path.exists(compacted_path):
+        os.remove(compacted_path)
+    db.execute("VACUUM INTO ?", (compacted_path,))
+    db.close()
+    os.replace(compacted_path, path)
+
+# writes predictions as gzipped CSV; a delta partition exports its deltas, with
+# an empty estimate_minutes for predictions which disappeared
+def export_partition(path, output_path):
+    db = sqlite3.connect(path)
+    count = 0
+    with gzip.open(output_path, "wt") as f:
+        writer = csv.writer(f)
+        writer.writerow(["created_at", "stop_id", "trip_id", "estimate_minutes"])
+        for created_at, prediction in _iter_predictions(db, _is_compact(db), 0, 2 ** 63 - 1):
+            writer.writerow([created_at, prediction.stop_id, prediction.trip_id, prediction.estimated_minutes])
+            count += 1
+    db.close()
+    return count
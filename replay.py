@@ -0,0 +1,190 @@
+import os
+import time
+import argparse
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from gtfs_map import GtfsMap
+from predictions import PredictionsStore, ROLLOVER_HOUR
+from feeds import FeedResult, parse_feed
+from archive import FeedArchive
+from wire import feed_header_timestamp
+import run
+
+# archive entries are found by fetch time but replayed by feed timestamp,
+# which may lag the fetch a little
+ARCHIVE_SLACK_SECONDS = 10 * 60
+
+# (timestamp, name, load) for each .pb file in a directory, whose name starts
+# with the feed it holds, e.g. trip_updates-201506010800.pb
+def directory_events(path, start=None, end=None):
+    events = []
+    for filename in os.listdir(path):
+        name = next((name for name in run.FEEDS if filename.startswith(name)), None)
+        if name is None or not filename.endswith(".pb"):
+            continue
+        file_path = os.path.join(path, filename)
+        with open(file_path, "rb") as f:
+            timestamp = feed_header_timestamp(f.read())
+        if timestamp is None or (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+            continue
+        events.append((timestamp, name, lambda file_path=file_path: open(file_path, "rb").read()))
+    return events
+
+def archive_events(path, start=None, end=None):
+    archive = FeedArchive(path)
+    events = []
+    for name in archive.names():
+        if name not in run.FEEDS:
+            continue
+        for entry in archive.entries(name, None if start is None else start - ARCHIVE_SLACK_SECONDS,
+                                     None if end is None else end + ARCHIVE_SLACK_SECONDS):
+            timestamp = entry.timestamp or entry.fetched_at
+            if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+                continue
+            events.append((timestamp, name, lambda name=name, entry=entry: archive.read(name, entry)))
+    return events
+
+def source_events(path, start=None, end=None):
+    if any(filename.endswith(".idx") for filename in os.listdir(path)):
+        return archive_events(path, start, end)
+    return directory_events(path, start, end)
+
+# Stands in for FeedFetcher: each fetch_all() returns the next recorded trip
+# updates, along with the latest of the other feeds recorded by then
+class ReplayFetcher(object):
+    def __init__(self, events, unparsed=()):
+        self.urls = dict((name, "replay") for name in run.FEEDS)
+        self.unparsed = set(unparsed)
+        # other feeds recorded at the same time as trip updates go with them
+        self._events = sorted(events, key=lambda event: (event[0], event[1] == "trip_updates"))
+        self._position = 0
+        self._latest = {}
+        self._timestamps = {}
+        self._pending = {}
+
+    # moves on to the next trip updates, False once there are none left
+    def advance(self):
+        while self._position < len(self._events):
+            timestamp, name, load = self._events[self._position]
+            self._position += 1
+            self._latest[name] = (timestamp, load)
+            if name == "trip_updates":
+                return True
+        return False
+
+    def fetch_all(self):
+        results = {}
+        for name in self.urls:
+            timestamp, load = self._latest.get(name, (None, None))
+            if timestamp is None or timestamp == self._timestamps.get(name):
+                results[name] = FeedResult(name=name, data=None, message=None, elapsed=0, timestamp=timestamp,
+                                           unchanged=True, validators=None)
+                continue
+            data = load()
+            message = None if name in self.unparsed else parse_feed(data)
+            results[name] = FeedResult(name=name, data=data, message=message, elapsed=0, timestamp=timestamp,
+                                       unchanged=False, validators=None)
+        self._pending = results
+        return results
+
+    def mark_processed(self):
+        for name, result in self._pending.items():
+            self._timestamps[name] = result.timestamp
+        self._pending = {}
+
+# Runs every recorded cycle through run.collect() into store, without waiting
+# between them. Returns the number of cycles replayed.
+def replay(gtfs_map, events, store, use_updates=True, vectorized=False, scanner=False):
+    unparsed = ["trip_updates", "vehicle_positions"] if scanner else []
+    fetcher = ReplayFetcher(events, unparsed)
+    cycles = 0
+    start = time.time()
+    while fetcher.advance():
+        run.collect(gtfs_map, use_updates, fetcher, store, vectorized, scanner=scanner)
+        store.commit()
+        fetcher.mark_processed()
+        cycles += 1
+        if cycles % 100 == 0:
+            print("Replayed %d cycles, %.1f cycles/sec" % (cycles, cycles / (time.time() - start)))
+    return cycles
+
+# Service day boundaries between start and end, so time ranges replayed in
+# parallel write to separate partitions
+def split_service_days(start, end):
+    boundaries = [start]
+    day = datetime.fromtimestamp(start).replace(hour=ROLLOVER_HOUR, minute=0, second=0, microsecond=0)
+    while True:
+        day += timedelta(1)
+        boundary = int(time.mktime(day.timetuple()))
+        if boundary >= end:
+            break
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    boundaries.append(end)
+    return list(zip(boundaries, boundaries[1:]))
+
+def _replay_range(task):
+    source, start, end, gtfs_path, db_path, store_options, replay_options = task
+    events = source_events(source, start, end)
+    gtfs_map = GtfsMap(gtfs_path, False, db_path=db_path, in_memory=replay_options["vectorized"])
+    store = PredictionsStore(**store_options)
+    return replay(gtfs_map, events, store, **replay_options)
+
+def parse_time(value):
+    return int(time.mktime(datetime.strptime(value, "%Y%m%d%H%M").timetuple()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded realtime feeds into a PredictionsStore, as fast as possible")
+    parser.add_argument("gtfs_path")
+    parser.add_argument("source", help="A FeedArchive directory, or a directory of <feed name>*.pb files")
+    parser.add_argument("--db-path", default="./temp_gtfs.db")
+    parser.add_argument("--output", default="./predictions.db")
+    parser.add_argument("--partition-dir", help="Write one predictions database per service date, required with --processes")
+    parser.add_argument("--start", help="YYYYMMDDHHMM, local time")
+    parser.add_argument("--end", help="YYYYMMDDHHMM, local time")
+    parser.add_argument("--processes", type=int, default=1, help="Replay service days in parallel")
+    parser.add_argument("--without-updates", action="store_true", help="Only use the schedule, like run.py without --use-updates")
+    parser.add_argument("--vectorized", action="store_true")
+    parser.add_argument("--scanner", action="store_true")
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--without-rowid", action="store_true")
+    parser.add_argument("--delta", action="store_true")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        raise Exception("source is not a directory")
+    if args.processes > 1 and not args.partition_dir:
+        raise Exception("--processes requires --partition-dir, so each worker writes its own databases")
+
+    start_time = time.time()
+    store_options = {"path": args.output, "compact": args.compact, "without_rowid": args.without_rowid,
+                     "delta": args.delta, "partition_dir": args.partition_dir}
+    replay_options = {"use_updates": not args.without_updates, "vectorized": args.vectorized, "scanner": args.scanner}
+
+    # build the schedule database once, before any workers read it
+    GtfsMap(args.gtfs_path, not os.path.isfile(args.db_path), db_path=args.db_path)
+
+    start = parse_time(args.start) if args.start else None
+    end = parse_time(args.end) if args.end else None
+    if args.processes <= 1:
+        cycles = _replay_range((args.source, start, end, args.gtfs_path, args.db_path, store_options, replay_options))
+    else:
+        if start is None or end is None:
+            timestamps = [timestamp for timestamp, name, load in source_events(args.source, start, end)]
+            if not timestamps:
+                raise Exception("No recorded feeds found")
+            start = start or min(timestamps)
+            end = end or max(timestamps) + 1
+        tasks = [(args.source, range_start, range_end, args.gtfs_path, args.db_path, store_options, replay_options)
+                 for range_start, range_end in split_service_days(start, end)]
+        pool = Pool(args.processes)
+        cycles = sum(pool.map(_replay_range, tasks))
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start_time
+    print("Replayed %d cycles in %.1fs (%.1f cycles/sec)" % (cycles, elapsed, cycles / max(elapsed, 0.001)))
+
+if __name__ == "__main__":
+    main()
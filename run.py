@@ -4,119 +4,388 @@ import argparse
 import hashlib
 import smtplib
 import time
+import threading
+import itertools
+import resource
 import gzip
 import json
 import sqlite3
 import gtfs_realtime_pb2
-import requests
 import time
-import re
-from datetime import datetime, timedelta
+from datetime import datetime
 from gtfs_map import Prediction, Location
 import calendar
 
 from predictions import make_timestamp
+from stop_times_index import seconds_since_midnight, SECONDS_PER_DAY, WINDOW_SECONDS
 
 ALERTS = "http://developer.mbta.com/lib/GTRTFS/Alerts/Alerts.pb"
 TRIP_UPDATES = "http://developer.mbta.com/lib/GTRTFS/Alerts/TripUpdates.pb"
 VEHICLE_POSITIONS = "http://developer.mbta.com/lib/GTRTFS/Alerts/VehiclePositions.pb"
 
-from gtfs_map import GtfsMap
+FEEDS = {"trip_updates": TRIP_UPDATES,
+         "vehicle_positions": VEHICLE_POSITIONS,
+         "alerts": ALERTS}
+FEED_TIMEOUTS = {"trip_updates": 20,
+                 "vehicle_positions": 10,
+                 "alerts": 10}
+# a poll fails when these can't be fetched, the others are skipped for that poll
+REQUIRED_FEEDS = ["trip_updates"]
+
+from gtfs_map import GtfsMap, DEFAULT_TRIP_CACHE_SIZE
 from predictions import PredictionsStore
+from feeds import FeedFetcher, FETCH_MODES
+from parallel_updates import UpdatesPool, scan_entity
+from wire import scan_trip_updates, scan_vehicle_positions, SCHEDULED, SKIPPED, NO_DATA
+from archive import FeedArchive
+from adherence import ScheduleAdherence
+from alerts import iter_alerts
+from metrics import Metrics, MetricsServer, NULL_METRICS
 from datetime import datetime
 
-def parse_gtfs_time(s, date):
-    groups = re.match("(\d+):(\d+):(\d+)", s).groups()
-    if int(groups[0]) >= 24:
-        s = "%d:%d:%d" % (int(groups[0]) - 24, int(groups[1]), int(groups[2]))
-        date += timedelta(1)
-    return datetime.combine(date, datetime.strptime(s, "%H:%M:%S").time())
+# predictions and locations are written to the store in batches of this size
+BATCH_SIZE = 5000
 
-def query_from_updates(trip_message, gtfs_map):
-    message_date = datetime.fromtimestamp(trip_message.header.timestamp)
-    predictions = []
-    used_trips = set()
-    for entity in trip_message.entity:
-        if entity.trip_update:
-            trip_id = entity.trip_update.trip.trip_id
-            for stop_time_update in entity.trip_update.stop_time_update:
-                stop_id = stop_time_update.stop_id
-
-                if stop_time_update.HasField("arrival"):
-                    if stop_time_update.arrival.HasField("time"):
-                        estimated_minutes = int((datetime.fromtimestamp(stop_time_update.arrival.time) - message_date).seconds / 60)
-                        
-                        prediction = Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=estimated_minutes)
-
-                        predictions.append(prediction)
-                        used_trips.add((str(stop_id), str(trip_id), stop_time_update.stop_sequence))
-                    elif stop_time_update.arrival.HasField("delay"):
-                        stop_times = list(gtfs_map.find_stop_times_for_stop_trip(stop_id, trip_id, stop_time_update.stop_sequence))
-                        if len(stop_times) == 0:
-                            print("Unable to find delay for stop %s trip %s %s" % (stop_id, trip_id, stop_time_update))
-                            continue
-                        elif len(stop_times) > 1:
-                            print("More than one trip found for stop %s trip %s %s" % (stop_id, trip_id, stop_time_update))
-                            continue
-                        stop_times = stop_times[0]
-                        arrival_date = parse_gtfs_time(stop_times['arrival_time'], message_date) + timedelta(0, stop_time_update.arrival.delay)
-
-                        if message_date < arrival_date:
-                            estimated_minutes = int((arrival_date - message_date).seconds / 60)
-                            prediction = Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=estimated_minutes)
-                            predictions.append(prediction)
-                        used_trips.add((str(stop_id), str(trip_id), stop_time_update.stop_sequence))
-    return predictions, used_trips
-
-
-def calculate(gtfs_map, use_updates):
-    locations = []
-    print ("Reading trip updates...")
-    data = requests.get(TRIP_UPDATES).content
-    trip_message = gtfs_realtime_pb2.FeedMessage()
-    trip_message.ParseFromString(data)
-        
+def batches(iterable, size=BATCH_SIZE):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+# Yields predictions from the trip updates, adding each (stop_id, trip_id,
+# stop_sequence) it covers to used_trips. See iter_propagated().
+def iter_updates(trip_message, gtfs_map, used_trips):
     message_date = datetime.fromtimestamp(trip_message.header.timestamp)
-    print("Getting vehicle positions...")
-    data = requests.get(VEHICLE_POSITIONS).content
-    vehicle_message = gtfs_realtime_pb2.FeedMessage()
-    vehicle_message.ParseFromString(data)
-
-    print("Going through trip updates...")
-    if use_updates:
-        predictions, used_trips = query_from_updates(trip_message, gtfs_map)
-    else:
-        predictions = []
-        used_trips = set()
-
-    print("Filtering against GTFS...")
+    updates = itertools.chain.from_iterable(scan_entity(entity) for entity in trip_message.entity)
+    return iter_propagated(updates, message_date, gtfs_map, used_trips)
+
+# iter_updates() for a feed still in its serialized form, decoded and scanned
+# by an UpdatesPool; only the schedule lookups happen in this process
+def iter_pooled_updates(data, message_date, gtfs_map, used_trips, pool):
+    return iter_propagated(pool.scan(data), message_date, gtfs_map, used_trips)
+
+# iter_updates() straight from the serialized feed with the wire.py scanner,
+# without building gtfs_realtime_pb2 messages
+def iter_scanned_updates(data, message_date, gtfs_map, used_trips):
+    return iter_propagated(scan_trip_updates(data), message_date, gtfs_map, used_trips)
+
+# Predictions from stop time updates given as (trip_id, stop_id, stop_sequence,
+# arrival_time, arrival_delay, schedule_relationship), as scan_entity() and
+# wire.scan_trip_updates() yield them. The updates are grouped by trip, and the
+# stop_times of a batch of trips are read at once.
+def iter_propagated(updates, message_date, gtfs_map, used_trips):
+    message_secs = seconds_since_midnight(message_date)
+    message_timestamp = int(time.mktime(message_date.timetuple()))
+    trips = {}
+    count = 0
+    previous_trip_id = None
+    for update in updates:
+        trip_id = update[0]
+        # only flush between trips, so a trip is propagated in one pass
+        if trip_id != previous_trip_id and count >= BATCH_SIZE:
+            for prediction in _propagate_trips(trips, gtfs_map, message_date, message_secs, message_timestamp, used_trips):
+                yield prediction
+            trips = {}
+            count = 0
+        trips.setdefault(trip_id, []).append(update[1:])
+        count += 1
+        previous_trip_id = trip_id
+    for prediction in _propagate_trips(trips, gtfs_map, message_date, message_secs, message_timestamp, used_trips):
+        yield prediction
+
+def _propagate_trips(trips, gtfs_map, message_date, message_secs, message_timestamp, used_trips):
+    if not trips:
+        return
+    stop_times = gtfs_map.find_stop_times_by_trip(trips)
+    for trip_id, trip_updates in trips.items():
+        for prediction in _propagate_trip(trip_id, trip_updates, stop_times[trip_id], message_date, message_secs, message_timestamp, used_trips):
+            yield prediction
+
+# One pass over a trip's stop_times in stop_sequence order, as the GTFS-realtime
+# spec asks: a stop with an update gets its arrival time, or its scheduled
+# arrival plus its delay, and that delay carries on to the following stops
+# without one. A SKIPPED stop gets no prediction and passes the delay on; a
+# NO_DATA stop stops it, leaving the stops after it to the schedule until the
+# next update. Stops before the first update are left to the schedule too.
+def _propagate_trip(trip_id, trip_updates, stop_times, message_date, message_secs, message_timestamp, used_trips):
+    updates = {}
+    for stop_id, stop_sequence, arrival_time, arrival_delay, schedule_relationship in trip_updates:
+        updates[(stop_id, stop_sequence)] = (arrival_time, arrival_delay, schedule_relationship)
+
+    # -1 for a trip of yesterday's service still running past midnight
+    day_offset = 0
+    last = max([arrival_secs for stop_sequence, stop_id, arrival_secs in stop_times if arrival_secs is not None] or [0])
+    if last >= message_secs + SECONDS_PER_DAY - WINDOW_SECONDS:
+        day_offset = -1
+
+    delay = None
+    matched = set()
+    for stop_sequence, rows in itertools.groupby(stop_times, key=lambda stop_time: stop_time[0]):
+        rows = list(rows)
+        if len(rows) > 1:
+            print("More than one trip found for trip %s stop_sequence %s" % (trip_id, stop_sequence))
+            delay = None
+            continue
+        stop_sequence, stop_id, arrival_secs = rows[0]
+        key = (str(stop_id), str(trip_id), stop_sequence)
+        scheduled = None if arrival_secs is None else arrival_secs + day_offset * SECONDS_PER_DAY
+        update = updates.get((stop_id, stop_sequence))
+        if update is not None:
+            matched.add((stop_id, stop_sequence))
+            arrival_time, arrival_delay, schedule_relationship = update
+            if schedule_relationship == SKIPPED:
+                used_trips.add(key)
+                continue
+            if schedule_relationship == NO_DATA:
+                delay = None
+                continue
+            if arrival_time is not None:
+                yield _arrival_prediction(stop_id, trip_id, arrival_time, message_date)
+                used_trips.add(key)
+                if scheduled is not None:
+                    delay = arrival_time - message_timestamp - (scheduled - message_secs)
+                continue
+            if arrival_delay is not None:
+                delay = arrival_delay
+        if delay is None or scheduled is None:
+            continue
+        seconds_until = scheduled + delay - message_secs
+        if seconds_until > 0:
+            yield Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=seconds_until // 60)
+        used_trips.add(key)
+
+    # updates for stops which aren't in the schedule
+    for (stop_id, stop_sequence), (arrival_time, arrival_delay, schedule_relationship) in updates.items():
+        if (stop_id, stop_sequence) in matched or schedule_relationship != SCHEDULED:
+            continue
+        if arrival_time is not None:
+            yield _arrival_prediction(stop_id, trip_id, arrival_time, message_date)
+            used_trips.add((str(stop_id), str(trip_id), stop_sequence))
+        elif arrival_delay is not None:
+            print("Unable to find delay for stop %s trip %s stop_sequence %s" % (stop_id, trip_id, stop_sequence))
+
+def _arrival_prediction(stop_id, trip_id, arrival_time, message_date):
+    estimated_minutes = int((datetime.fromtimestamp(arrival_time) - message_date).seconds / 60)
+    return Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=estimated_minutes)
+
+# scheduled arrivals for stops not covered by an update
+def iter_scheduled(message_date, gtfs_map, used_trips):
+    message_secs = seconds_since_midnight(message_date)
     for stop_times in gtfs_map.find_stop_times_for_datetime(message_date):
         stop_id = stop_times['stop_id']
         trip_id = stop_times['trip_id']
         key = (str(stop_id), str(trip_id), int(stop_times['stop_sequence']))
         if key not in used_trips:
-            arrival_date = parse_gtfs_time(stop_times['arrival_time'], message_date)
+            seconds_until = stop_times['arrival_secs'] + stop_times['day_offset'] * SECONDS_PER_DAY - message_secs
 
-            if message_date < arrival_date:
-                estimated_minutes = int((arrival_date - message_date).seconds / 60)
-                prediction = Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=estimated_minutes)
-                predictions.append(prediction)
-                        
-    vehicle_message_date = datetime.fromtimestamp(vehicle_message.header.timestamp)
-    print("Writing vehicle positions to database...")
+            if seconds_until > 0:
+                estimated_minutes = seconds_until // 60
+                yield Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=estimated_minutes)
+
+# the used_trips set is the only state kept while predictions stream through
+def iter_predictions(trip_message, gtfs_map, use_updates):
+    message_date = datetime.fromtimestamp(trip_message.header.timestamp)
+    used_trips = set()
+    if use_updates:
+        print("Going through trip updates...")
+        for prediction in iter_updates(trip_message, gtfs_map, used_trips):
+            yield prediction
+
+    print("Filtering against GTFS...")
+    for prediction in iter_scheduled(message_date, gtfs_map, used_trips):
+        yield prediction
+
+def calculate_predictions(trip_message, gtfs_map, use_updates):
+    message_date = datetime.fromtimestamp(trip_message.header.timestamp)
+    return list(iter_predictions(trip_message, gtfs_map, use_updates)), message_date
+
+def iter_locations(vehicle_message):
     for entity in vehicle_message.entity:
         if entity.vehicle:
             lat = entity.vehicle.position.latitude
             lon = entity.vehicle.position.longitude
             trip_id = entity.vehicle.trip.trip_id
             stop_id = entity.vehicle.stop_id
+            timestamp = entity.vehicle.timestamp if entity.vehicle.HasField("timestamp") else None
+
+            yield Location(trip_id=trip_id, lat=lat, lon=lon, stop_id=stop_id, timestamp=timestamp)
+
+def iter_scanned_locations(data):
+    for trip_id, stop_id, lat, lon, timestamp in scan_vehicle_positions(data):
+        yield Location(trip_id=trip_id, lat=lat, lon=lon, stop_id=stop_id, timestamp=timestamp)
 
-            locations.append(Location(trip_id=trip_id, lat=lat, lon=lon, stop_id=stop_id))
-                
+# fills in the nearest stop for vehicles which the feed gave no stop_id
+def snap_stop_ids(spatial_index, locations):
+    missing = [location for location in locations if not location.stop_id]
+    if not missing:
+        return locations
+    snapped = dict((id(location), snap.stop_id) for location, snap in zip(missing, spatial_index.snap_locations(missing)))
+    return [location._replace(stop_id=snapped[id(location)]) if id(location) in snapped and snapped[id(location)] is not None else location
+            for location in locations]
+
+def calculate_locations(vehicle_message):
+    vehicle_message_date = datetime.fromtimestamp(vehicle_message.header.timestamp)
+    return list(iter_locations(vehicle_message)), vehicle_message_date
+
+# predictions and locations are None when their feed hasn't changed since the
+# last poll passed to fetcher.mark_processed()
+def calculate(gtfs_map, use_updates, fetcher=None):
+    if fetcher is None:
+        fetcher = FeedFetcher(FEEDS, timeouts=FEED_TIMEOUTS, required=REQUIRED_FEEDS)
+    print ("Fetching %s..." % ", ".join(fetcher.urls))
+    feeds = fetcher.fetch_all()
+    report_failed_feeds(feeds)
+
+    predictions, message_date = None, None
+    if feeds["trip_updates"].unchanged:
+        print("Trip updates unchanged, skipping predictions")
+    else:
+        predictions, message_date = calculate_predictions(feeds["trip_updates"].message, gtfs_map, use_updates)
+
+    locations, vehicle_message_date = None, None
+    if feeds["vehicle_positions"].unchanged:
+        print("Vehicle positions unchanged, skipping locations")
+    else:
+        locations, vehicle_message_date = calculate_locations(feeds["vehicle_positions"].message)
 
     return (predictions, message_date, locations, vehicle_message_date)
 
-def run_downloader(gtfs_path):
+# feeds which failed to fetch are skipped as if unchanged, say so
+def report_failed_feeds(feeds, metrics=NULL_METRICS):
+    for name, result in feeds.items():
+        if result.error is not None:
+            print("Fetching %s failed, skipping it: %s" % (name, result.error))
+            metrics.count("%s_errors" % name)
+
+# keeps the raw payloads, for replay.py
+def archive_feeds(archive, feeds):
+    for name, result in feeds.items():
+        if result.data is not None:
+            if not archive.append(name, result.data, result.timestamp):
+                print("%s unchanged, archived a reference to it" % name)
+
+# Streams this poll's predictions and locations into the store a batch at a
+# time, instead of building whole lists like calculate(). Returns the number
+# of predictions and locations written, None for a feed which hasn't changed.
+# Time spent producing each batch goes to the updates, schedule and locations
+# stages of metrics, writing it to the store's insert stage. snap fills in
+# the nearest stop for vehicles without one, from the GtfsMap's spatial index.
+def collect(gtfs_map, use_updates, fetcher, store, vectorized=False, pool=None, scanner=False, archive=None, metrics=NULL_METRICS,
+            adherence=None, snap=False):
+    print ("Fetching %s..." % ", ".join(fetcher.urls))
+    with metrics.stage("fetch"):
+        feeds = fetcher.fetch_all()
+    for name, result in feeds.items():
+        # fetched and parsed concurrently, so these overlap
+        metrics.add_time("fetch_%s" % name, result.elapsed)
+        if result.data is not None:
+            metrics.count("%s_bytes" % name, len(result.data))
+    report_failed_feeds(feeds, metrics)
+    if archive is not None:
+        with metrics.stage("archive"):
+            archive_feeds(archive, feeds)
+
+    prediction_count = None
+    if feeds["trip_updates"].unchanged:
+        print("Trip updates unchanged, skipping predictions")
+    else:
+        result = feeds["trip_updates"]
+        message_date = datetime.fromtimestamp(result.timestamp)
+        used_trips = set()
+        updates = []
+        if use_updates:
+            print("Going through trip updates...")
+            if pool is not None:
+                updates = iter_pooled_updates(result.data, message_date, gtfs_map, used_trips, pool)
+            elif scanner:
+                updates = iter_scanned_updates(result.data, message_date, gtfs_map, used_trips)
+            else:
+                updates = iter_updates(result.message, gtfs_map, used_trips)
+        prediction_count = 0
+        for batch in metrics.timed("updates", batches(updates)):
+            store.add_predictions(batch, message_date)
+            prediction_count += len(batch)
+
+        print("Filtering against GTFS...")
+        if vectorized:
+            with metrics.stage("schedule"):
+                prediction_count += add_vectorized_schedule(message_date, gtfs_map, used_trips, store)
+        else:
+            for batch in metrics.timed("schedule", batches(iter_scheduled(message_date, gtfs_map, used_trips))):
+                store.add_predictions(batch, message_date)
+                prediction_count += len(batch)
+
+    location_count = None
+    if feeds["vehicle_positions"].unchanged:
+        print("Vehicle positions unchanged, skipping locations")
+    else:
+        result = feeds["vehicle_positions"]
+        vehicle_message_date = datetime.fromtimestamp(result.timestamp)
+        if scanner:
+            locations = iter_scanned_locations(result.data)
+        else:
+            locations = iter_locations(result.message)
+        print("Writing vehicle positions to database...")
+        location_count = 0
+        for batch in metrics.timed("locations", batches(locations)):
+            if snap:
+                with metrics.stage("snap"):
+                    batch = snap_stop_ids(gtfs_map.spatial_index, batch)
+            if adherence is not None:
+                with metrics.stage("adherence"):
+                    batch = adherence.with_delays(batch, vehicle_message_date)
+            store.add_locations(batch, vehicle_message_date)
+            location_count += len(batch)
+
+    if feeds["alerts"].unchanged:
+        print("Alerts unchanged, skipping alerts")
+    else:
+        result = feeds["alerts"]
+        with metrics.stage("alerts"):
+            alerts = list(iter_alerts(result.message))
+            new_alerts = store.add_alerts(alerts, datetime.fromtimestamp(result.timestamp))
+        print("%d alerts, %d new" % (len(alerts), new_alerts))
+
+    return prediction_count, location_count
+
+# The schedule pass of collect() computed over NumPy views of the in-memory
+# StopTimesIndex and written as one columnar batch
+def add_vectorized_schedule(message_date, gtfs_map, used_trips, store):
+    try:
+        from vectorized import ScheduleArrays
+    except ImportError:
+        raise Exception("Vectorized predictions require numpy")
+    if gtfs_map.stop_times_index is None:
+        raise Exception("Vectorized predictions require the in-memory stop times index")
+
+    columns = ScheduleArrays(gtfs_map.stop_times_index).scheduled_columns(message_date, used_trips)
+    store.add_prediction_columns(columns, message_date)
+    return len(columns.estimated_minutes)
+
+# Peak resident set size in kB since the last reset_peak_rss(). Linux resets
+# the high water mark through clear_refs; elsewhere this falls back to the
+# peak for the whole process.
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_downloader(gtfs_path, in_memory, fetcher, predictions, cache_schedules=False, vectorized=False, pool=None, scanner=False, archive=None,
+                   metrics=NULL_METRICS, snap_vehicles=False, schedule_adherence=False, trip_cache_size=DEFAULT_TRIP_CACHE_SIZE):
     if not os.path.isfile("./temp_gtfs.db"):
         print("Initializing gtfs map...")
         reinitialize = True
@@ -124,26 +393,35 @@ def run_downloader(gtfs_path):
         reinitialize = False
 
     print("Initializing GtfsMap...")
-    gtfs_map = GtfsMap(gtfs_path, reinitialize)
+    gtfs_map = GtfsMap(gtfs_path, reinitialize, in_memory=in_memory, bulk_load=reinitialize, cache_schedules=cache_schedules, metrics=metrics,
+                       trip_cache_size=trip_cache_size, spatial=snap_vehicles or schedule_adherence)
+    adherence = ScheduleAdherence(gtfs_map) if schedule_adherence else None
 
-    predictions = PredictionsStore()
+    refresh_thread = None
     while True:
         try:
             starting_date = datetime.now()
-        
-            prediction_list, prediction_date, location_list, location_date = calculate(gtfs_map, True)
-
-            for prediction in prediction_list:
-                predictions.add_prediction(prediction, prediction_date)
+            metrics.start_cycle()
 
-            for location in location_list:
-                predictions.add_location(location, location_date)
+            # pick up a new static feed in the background, collection keeps running on the old one
+            if refresh_thread is None or not refresh_thread.is_alive():
+                refresh_thread = threading.Thread(target=gtfs_map.refresh, args=(gtfs_path,))
+                refresh_thread.daemon = True
+                refresh_thread.start()
+        
+            reset_peak_rss()
+            prediction_count, location_count = collect(gtfs_map, True, fetcher, predictions, vectorized, pool, scanner, archive, metrics,
+                                                       adherence, snap_vehicles)
 
             predictions.commit()
+            fetcher.mark_processed()
+            print("Wrote %s predictions and %s locations, peak RSS %.1f MB" %
+                  (prediction_count, location_count, peak_rss() / 1024.0))
+            metrics.end_cycle(predictions=prediction_count, locations=location_count, peak_rss_mb=peak_rss() / 1024.0)
 
             now = datetime.now()
             diff = now - starting_date
-            print ("That took %s") % diff
+            print ("That took %s" % diff)
             if diff.seconds > 60:
                 print("Not sleeping, execution longer than a minute")
             else:
@@ -152,6 +430,7 @@ def run_downloader(gtfs_path):
 
         except Exception as e:
             print(e)
+            metrics.end_cycle(error=str(e))
             time.sleep(60)
 
 def send_email(msg):
@@ -174,19 +453,65 @@ def main():
     parser.add_argument("gtfs_path")
     parser.add_argument("--test", action="store_true")
     parser.add_argument('--use-updates', action='store_true')
+    parser.add_argument('--in-memory', action='store_true', help="Keep stop_times in memory instead of querying SQLite every poll")
+    parser.add_argument('--trip-cache-size', type=int, default=DEFAULT_TRIP_CACHE_SIZE,
+                        help="Trips whose stop_times are kept in memory for matching realtime updates")
+    parser.add_argument('--cache-schedules', action='store_true', help="Read each service day's schedule once instead of querying SQLite every poll")
+    parser.add_argument('--vectorized', action='store_true', help="With --in-memory, compute scheduled predictions with NumPy")
+    decoding = parser.add_mutually_exclusive_group()
+    decoding.add_argument('--processes', type=int, default=0, help="Experimental: decode trip updates in this many worker processes, 0 to decode them in this one. "
+                          "Only decoding runs in the workers; the speed-up on several cores is unmeasured, and --scanner is faster on one")
+    decoding.add_argument('--scanner', action='store_true', help="Read trip updates and vehicle positions straight from the wire format")
+    parser.add_argument('--compact', action='store_true', help="Store predictions with interned ids and integer timestamps")
+    parser.add_argument('--without-rowid', action='store_true', help="With --compact, cluster predictions by time and stop")
+    parser.add_argument('--delta', action='store_true', help="Only store predictions which changed since the last poll")
+    parser.add_argument('--fetch-mode', choices=FETCH_MODES, default="threads", help="How to fetch the realtime feeds each poll")
+    parser.add_argument('--archive-dir', help="Keep every fetched feed in a compressed archive in this directory")
+    parser.add_argument('--partition-dir', help="Write one predictions database per service date into this directory")
+    parser.add_argument('--snap-vehicles', action='store_true', help="Fill in the nearest stop for vehicle positions without a stop_id")
+    parser.add_argument('--schedule-adherence', action='store_true', help="Store how far behind schedule each vehicle is with its location")
+    parser.add_argument('--metrics-file', help="Append per-stage timings and counters for each poll to this file as JSON lines")
+    parser.add_argument('--metrics-port', type=int, help="Serve the last poll's metrics in Prometheus text format on localhost:PORT/metrics")
     args = parser.parse_args()
 
     if not os.path.isdir(args.gtfs_path):
         raise Exception("gtfs_path is not a directory")
+    if args.vectorized and not args.in_memory:
+        raise Exception("--vectorized requires --in-memory")
 
     if args.test:
         global results
-        results = calculate(GtfsMap(args.gtfs_path, False), args.use_updates)
+        gtfs_map = GtfsMap(args.gtfs_path, False, in_memory=args.in_memory, cache_schedules=args.cache_schedules)
+        results = calculate(gtfs_map, args.use_updates, FeedFetcher(FEEDS, args.fetch_mode, FEED_TIMEOUTS, required=REQUIRED_FEEDS))
         for prediction in results[0]:
             print(prediction)
         return
 
-    run_downloader(args.gtfs_path)
+    pool = None
+    if args.processes:
+        # the pool decodes trip updates itself, from the raw feed
+        fetcher = FeedFetcher(FEEDS, args.fetch_mode, FEED_TIMEOUTS, unparsed=["trip_updates"], required=REQUIRED_FEEDS)
+        pool = UpdatesPool(args.processes)
+    elif args.scanner:
+        fetcher = FeedFetcher(FEEDS, args.fetch_mode, FEED_TIMEOUTS, unparsed=["trip_updates", "vehicle_positions"],
+                              required=REQUIRED_FEEDS)
+    else:
+        fetcher = FeedFetcher(FEEDS, args.fetch_mode, FEED_TIMEOUTS, required=REQUIRED_FEEDS)
+
+    archive = None
+    if args.archive_dir:
+        archive = FeedArchive(args.archive_dir)
+
+    metrics = NULL_METRICS
+    if args.metrics_file or args.metrics_port:
+        metrics = Metrics(args.metrics_file)
+        if args.metrics_port:
+            MetricsServer(metrics, args.metrics_port)
+
+    predictions = PredictionsStore(compact=args.compact, without_rowid=args.without_rowid, delta=args.delta,
+                                   partition_dir=args.partition_dir, metrics=metrics)
+    run_downloader(args.gtfs_path, args.in_memory, fetcher, predictions, args.cache_schedules, args.vectorized, pool, args.scanner, archive,
+                   metrics, args.snap_vehicles, args.schedule_adherence, args.trip_cache_size)
 
     
         
@@ -0,0 +1,226 @@
+import math
+from array import array
+from collections import namedtuple
+
+from stop_times_index import _intern
+
+EARTH_RADIUS_METERS = 6371000.0
+DEFAULT_CELL_METERS = 250
+# positions further than this from every stop or shape are left unsnapped
+DEFAULT_MAX_DISTANCE_METERS = 1000
+
+# The nearest stop to a position, and the nearest point on a shape: the
+# trip's own when it's known, otherwise any. Distances are in meters,
+# shape_pt_sequence is where the matched segment starts. Fields are None when
+# nothing is within the maximum distance.
+Snap = namedtuple('Snap', ['stop_id', 'stop_distance', 'shape_id', 'shape_pt_sequence', 'shape_distance', 'shape_lat', 'shape_lon'])
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# Stops and shape segments bucketed into a uniform grid of square cells, on an
+# equirectangular projection around the feed's mean latitude which is accurate
+# to well under a meter across a city. Lookups search rings of cells outwards
+# from the position's cell and stop once the next ring can't hold anything
+# closer.
+class SpatialIndex(object):
+    def __init__(self, db, cell_meters=DEFAULT_CELL_METERS):
+        self.cell_meters = cell_meters
+
+        stops = []
+        for row in db.execute("SELECT stop_id, stop_lat, stop_lon FROM stops"):
+            lat = _float(row["stop_lat"])
+            lon = _float(row["stop_lon"])
+            if lat is not None and lon is not None:
+                stops.append((row["stop_id"], lat, lon))
+        points = []
+        for row in db.execute("SELECT shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence FROM shapes ORDER BY shape_id, shape_pt_sequence"):
+            lat = _float(row["shape_pt_lat"])
+            lon = _float(row["shape_pt_lon"])
+            if lat is not None and lon is not None:
+                points.append((row["shape_id"], lat, lon, row["shape_pt_sequence"]))
+
+        latitudes = [lat for stop_id, lat, lon in stops] + [lat for shape_id, lat, lon, sequence in points]
+        longitudes = [lon for stop_id, lat, lon in stops] + [lon for shape_id, lat, lon, sequence in points]
+        self._lat0 = sum(latitudes) / len(latitudes) if latitudes else 0.0
+        self._lon0 = sum(longitudes) / len(longitudes) if longitudes else 0.0
+        self._meters_per_lat = EARTH_RADIUS_METERS * math.pi / 180
+        self._meters_per_lon = self._meters_per_lat * math.cos(math.radians(self._lat0))
+
+        self.stop_ids = []
+        self._stop_x = array('d')
+        self._stop_y = array('d')
+        # (cell x, cell y) -> indexes into stop_ids
+        self._stop_cells = {}
+        for stop_id, lat, lon in stops:
+            x, y = self.project(lat, lon)
+            self._stop_cells.setdefault(self._cell(x, y), []).append(len(self.stop_ids))
+            self.stop_ids.append(stop_id)
+            self._stop_x.append(x)
+            self._stop_y.append(y)
+
+        self.shape_ids = []
+        self.shape_lookup = {}
+        self._segment_shapes = array('i')
+        self._segment_sequences = array('i')
+        self._segment_coordinates = array('d')
+        # meters along its shape where each segment starts
+        self._segment_offsets = array('d')
+        # (cell x, cell y) -> indexes of the segments whose bounding box overlaps it
+        self._segment_cells = {}
+        previous = None
+        offset = 0.0
+        for shape_id, lat, lon, sequence in points:
+            x, y = self.project(lat, lon)
+            if previous is not None and previous[0] == shape_id:
+                self._add_segment(shape_id, previous[3], offset, previous[1], previous[2], x, y)
+                offset += math.hypot(x - previous[1], y - previous[2])
+            else:
+                offset = 0.0
+            previous = (shape_id, x, y, sequence)
+
+        self.trip_shapes = {}
+        for row in db.execute("SELECT trip_id, shape_id FROM trips"):
+            shape = self.shape_lookup.get(row["shape_id"])
+            if shape is not None:
+                self.trip_shapes[row["trip_id"]] = shape
+
+    def project(self, lat, lon):
+        return (lon - self._lon0) * self._meters_per_lon, (lat - self._lat0) * self._meters_per_lat
+
+    def unproject(self, x, y):
+        return self._lat0 + y / self._meters_per_lat, self._lon0 + x / self._meters_per_lon
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_meters)), int(math.floor(y / self.cell_meters))
+
+    def _add_segment(self, shape_id, sequence, offset, x1, y1, x2, y2):
+        segment = len(self._segment_shapes)
+        self._segment_shapes.append(_intern(shape_id, self.shape_ids, self.shape_lookup))
+        self._segment_sequences.append(sequence)
+        self._segment_offsets.append(offset)
+        self._segment_coordinates.extend((x1, y1, x2, y2))
+        min_x, min_y = self._cell(min(x1, x2), min(y1, y2))
+        max_x, max_y = self._cell(max(x1, x2), max(y1, y2))
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                self._segment_cells.setdefault((cell_x, cell_y), []).append(segment)
+
+    def _rings(self, x, y, max_distance):
+        cell_x, cell_y = self._cell(x, y)
+        for ring in range(int(max_distance // self.cell_meters) + 2):
+            if ring == 0:
+                yield ring, [(cell_x, cell_y)]
+                continue
+            cells = []
+            for dx in range(-ring, ring + 1):
+                cells.append((cell_x + dx, cell_y - ring))
+                cells.append((cell_x + dx, cell_y + ring))
+            for dy in range(-ring + 1, ring):
+                cells.append((cell_x - ring, cell_y + dy))
+                cells.append((cell_x + ring, cell_y + dy))
+            yield ring, cells
+
+    # (index into stop_ids, distance) of the nearest stop to projected x, y,
+    # or (None, None)
+    def _nearest_stop(self, x, y, max_distance):
+        best = None
+        best_distance = max_distance
+        stop_cells = self._stop_cells
+        stop_x = self._stop_x
+        stop_y = self._stop_y
+        for ring, cells in self._rings(x, y, max_distance):
+            # everything in this ring is at least ring - 1 cells away
+            if (ring - 1) * self.cell_meters > best_distance:
+                break
+            for cell in cells:
+                for stop in stop_cells.get(cell, ()):
+                    distance = math.hypot(stop_x[stop] - x, stop_y[stop] - y)
+                    if distance <= best_distance:
+                        best = stop
+                        best_distance = distance
+        if best is None:
+            return None, None
+        return best, best_distance
+
+    # (segment index, distance, projected x, y of the nearest point) on the
+    # nearest segment to x, y, only of shape when it isn't None
+    def _nearest_segment(self, x, y, shape, max_distance):
+        best = None
+        best_distance = max_distance
+        segment_cells = self._segment_cells
+        segment_shapes = self._segment_shapes
+        coordinates = self._segment_coordinates
+        for ring, cells in self._rings(x, y, max_distance):
+            if (ring - 1) * self.cell_meters > best_distance:
+                break
+            for cell in cells:
+                for segment in segment_cells.get(cell, ()):
+                    if shape is not None and segment_shapes[segment] != shape:
+                        continue
+                    x1, y1, x2, y2 = coordinates[4 * segment:4 * segment + 4]
+                    dx = x2 - x1
+                    dy = y2 - y1
+                    length = dx * dx + dy * dy
+                    t = 0.0 if length == 0 else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length))
+                    px = x1 + t * dx
+                    py = y1 + t * dy
+                    distance = math.hypot(px - x, py - y)
+                    if distance <= best_distance:
+                        best = (segment, distance, px, py)
+                        best_distance = distance
+        return best
+
+    # the nearest stop_id and its distance in meters, or (None, None)
+    def nearest_stop(self, lat, lon, max_distance=DEFAULT_MAX_DISTANCE_METERS):
+        stop, distance = self._nearest_stop(*self.project(lat, lon), max_distance=max_distance)
+        return (None, None) if stop is None else (self.stop_ids[stop], distance)
+
+    # (meters along shape_id, meters away from it) of the nearest point on the
+    # shape to a position, or None when the shape is unknown or further away
+    # than max_distance
+    def locate_on_shape(self, lat, lon, shape_id, max_distance=DEFAULT_MAX_DISTANCE_METERS):
+        shape = self.shape_lookup.get(shape_id)
+        if shape is None:
+            return None
+        x, y = self.project(lat, lon)
+        nearest = self._nearest_segment(x, y, shape, max_distance)
+        if nearest is None:
+            return None
+        segment, distance, px, py = nearest
+        x1 = self._segment_coordinates[4 * segment]
+        y1 = self._segment_coordinates[4 * segment + 1]
+        return self._segment_offsets[segment] + math.hypot(px - x1, py - y1), distance
+
+    # Snaps a batch of positions in one call. positions are (lat, lon,
+    # trip_id), trip_id may be None. Returns a Snap for each position, in order.
+    def snap(self, positions, max_distance=DEFAULT_MAX_DISTANCE_METERS):
+        snaps = []
+        stop_ids = self.stop_ids
+        shape_ids = self.shape_ids
+        trip_shapes = self.trip_shapes
+        for lat, lon, trip_id in positions:
+            if lat is None or lon is None:
+                snaps.append(Snap(None, None, None, None, None, None, None))
+                continue
+            x, y = self.project(lat, lon)
+            stop, stop_distance = self._nearest_stop(x, y, max_distance)
+            segment = self._nearest_segment(x, y, trip_shapes.get(trip_id), max_distance)
+            if segment is None:
+                shape_id = shape_pt_sequence = shape_distance = shape_lat = shape_lon = None
+            else:
+                index, shape_distance, px, py = segment
+                shape_id = shape_ids[self._segment_shapes[index]]
+                shape_pt_sequence = self._segment_sequences[index]
+                shape_lat, shape_lon = self.unproject(px, py)
+            snaps.append(Snap(stop_id=None if stop is None else stop_ids[stop], stop_distance=stop_distance,
+                              shape_id=shape_id, shape_pt_sequence=shape_pt_sequence, shape_distance=shape_distance,
+                              shape_lat=shape_lat, shape_lon=shape_lon))
+        return snaps
+
+    # snap() for gtfs_map.Location tuples
+    def snap_locations(self, locations, max_distance=DEFAULT_MAX_DISTANCE_METERS):
+        return self.snap(((location.lat, location.lon, location.trip_id or None) for location in locations), max_distance)
@@ -0,0 +1,170 @@
+import bisect
+from array import array
+from datetime import timedelta
+
+SECONDS_PER_DAY = 24 * 60 * 60
+WINDOW_SECONDS = 30 * 60
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+def parse_gtfs_seconds(s):
+    hours, minutes, seconds = s.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+def format_gtfs_time(secs):
+    return "%02d:%02d:%02d" % (secs // 3600, secs // 60 % 60, secs % 60)
+
+def seconds_since_midnight(date):
+    return date.hour * 3600 + date.minute * 60 + date.second
+
+def _intern(value, values, lookup):
+    index = lookup.get(value)
+    if index is None:
+        index = len(values)
+        lookup[value] = index
+        values.append(value)
+    return index
+
+# stop_times held in memory as parallel arrays sorted by arrival time. Trip, stop,
+# route and service ids are interned so each stop time is a handful of ints
+class StopTimesIndex(object):
+    def __init__(self, db):
+        self.trip_ids = []
+        self.stop_ids = []
+        self.route_ids = []
+        self.service_ids = []
+        # id -> index into trip_ids and stop_ids
+        self.trip_lookup = trip_lookup = {}
+        self.stop_lookup = stop_lookup = {}
+        route_lookup = {}
+        service_lookup = {}
+
+        self.trip_route = array('i')
+        self.trip_service = array('i')
+        for row in db.execute("SELECT trip_id, route_id, service_id FROM trips"):
+            _intern(row[0], self.trip_ids, trip_lookup)
+            self.trip_route.append(_intern(row[1], self.route_ids, route_lookup))
+            self.trip_service.append(_intern(row[2], self.service_ids, service_lookup))
+
+        # date -> indexes of the services running that day
+        self._active_days = {}
+        for date_string, service_id in db.execute("SELECT date, service_id FROM active_services"):
+            if service_id in service_lookup:
+                self._active_days.setdefault(date_string, []).append(service_lookup[service_id])
+        self._active_cache = {}
+
+        arrival = array('i')
+        departure = array('i')
+        trip = array('i')
+        stop = array('i')
+        sequence = array('i')
+        query = "SELECT trip_id, stop_id, stop_sequence, arrival_secs, departure_secs FROM stop_times"
+        for trip_id, stop_id, stop_sequence, arrival_secs, departure_secs in db.execute(query):
+            trip_index = trip_lookup.get(trip_id)
+            if trip_index is None or arrival_secs is None:
+                continue
+            arrival.append(arrival_secs)
+            departure.append(departure_secs if departure_secs is not None else arrival_secs)
+            trip.append(trip_index)
+            stop.append(_intern(stop_id, self.stop_ids, stop_lookup))
+            sequence.append(int(stop_sequence))
+
+        order = sorted(range(len(arrival)), key=arrival.__getitem__)
+        self.arrival = array('i', (arrival[i] for i in order))
+        self.departure = array('i', (departure[i] for i in order))
+        self.trip = array('i', (trip[i] for i in order))
+        self.stop = array('i', (stop[i] for i in order))
+        self.stop_sequence = array('i', (sequence[i] for i in order))
+
+    def __len__(self):
+        return len(self.arrival)
+
+    def active_services(self, date):
+        date_string = date.strftime("%Y%m%d")
+        active = self._active_cache.get(date_string)
+        if active is None:
+            active = bytearray(len(self.service_ids))
+            for service in self._active_days.get(date_string, []):
+                active[service] = 1
+            self._active_cache[date_string] = active
+        return active
+
+    def window(self, start_secs, end_secs):
+        return (bisect.bisect_left(self.arrival, start_secs),
+                bisect.bisect_left(self.arrival, end_secs))
+
+    def _rows_for_service_day(self, service_date, day_offset, start_secs, end_secs):
+        active = self.active_services(service_date)
+        lo, hi = self.window(start_secs, end_secs)
+        for i in range(lo, hi):
+            trip = self.trip[i]
+            if not active[self.trip_service[trip]]:
+                continue
+            yield {"trip_id": self.trip_ids[trip],
+                   "arrival_time": format_gtfs_time(self.arrival[i]),
+                   "departure_time": format_gtfs_time(self.departure[i]),
+                   "stop_id": self.stop_ids[self.stop[i]],
+                   "stop_sequence": self.stop_sequence[i],
+                   "arrival_secs": self.arrival[i],
+                   "departure_secs": self.departure[i],
+                   "route_id": self.route_ids[self.trip_route[trip]],
+                   "day_offset": day_offset}
+
+    def find_stop_times_for_datetime(self, date):
+        now = seconds_since_midnight(date)
+        for row in self._rows_for_service_day(date, 0, now - WINDOW_SECONDS, now + WINDOW_SECONDS):
+            yield row
+        # trips belonging to yesterday's service which run past midnight
+        now += SECONDS_PER_DAY
+        for row in self._rows_for_service_day(date + timedelta(-1), -1, now - WINDOW_SECONDS, now + WINDOW_SECONDS):
+            yield row
+
+# The stop times of one service day's active trips, as arrays sorted by
+# arrival time, so each poll only has to bisect out its window
+class ServiceDaySchedule(object):
+    def __init__(self, db, service_date):
+        self.service_date = service_date
+        self.trip_ids = []
+        self.stop_ids = []
+        self.route_ids = []
+        trip_lookup = {}
+        stop_lookup = {}
+        route_lookup = {}
+
+        self.trip_route = array('i')
+        self.arrival = array('i')
+        self.departure = array('i')
+        self.trip = array('i')
+        self.stop = array('i')
+        self.stop_sequence = array('i')
+        query = ("SELECT s_t.trip_id, s_t.stop_id, s_t.stop_sequence, s_t.arrival_secs, s_t.departure_secs, t.route_id "
+                 "FROM active_services AS a JOIN trips AS t ON t.service_id = a.service_id JOIN stop_times AS s_t ON s_t.trip_id = t.trip_id "
+                 "WHERE a.date = ? AND s_t.arrival_secs IS NOT NULL ORDER BY s_t.arrival_secs")
+        for trip_id, stop_id, stop_sequence, arrival_secs, departure_secs, route_id in db.execute(query, (service_date.strftime("%Y%m%d"),)):
+            trip = trip_lookup.get(trip_id)
+            if trip is None:
+                trip = _intern(trip_id, self.trip_ids, trip_lookup)
+                self.trip_route.append(_intern(route_id, self.route_ids, route_lookup))
+            self.arrival.append(arrival_secs)
+            self.departure.append(departure_secs if departure_secs is not None else arrival_secs)
+            self.trip.append(trip)
+            self.stop.append(_intern(stop_id, self.stop_ids, stop_lookup))
+            self.stop_sequence.append(int(stop_sequence))
+
+    def __len__(self):
+        return len(self.arrival)
+
+    def rows(self, day_offset, start_secs, end_secs):
+        lo = bisect.bisect_left(self.arrival, start_secs)
+        hi = bisect.bisect_left(self.arrival, end_secs)
+        for i in range(lo, hi):
+            trip = self.trip[i]
+            yield {"trip_id": self.trip_ids[trip],
+                   "arrival_time": format_gtfs_time(self.arrival[i]),
+                   "departure_time": format_gtfs_time(self.departure[i]),
+                   "stop_id": self.stop_ids[self.stop[i]],
+                   "stop_sequence": self.stop_sequence[i],
+                   "arrival_secs": self.arrival[i],
+                   "departure_secs": self.departure[i],
+                   "route_id": self.route_ids[self.trip_route[trip]],
+                   "day_offset": day_offset}
@@ -12,7 +12,7 @@ def main():
         for row in gtfs_map.find_stop_times_for_datetime(datetime.datetime.now()):
                 rows.append(row)
 
-        rows = sorted(rows, key=lambda row: row['arrival_time'])
+        rows = sorted(rows, key=lambda row: (row['day_offset'], row['arrival_secs']))
         for row in rows:
                 print(row)
 
@@ -0,0 +1,89 @@
+from datetime import datetime
+
+import pytest
+
+import run
+from gtfs_map import GtfsMap
+from parallel_updates import UpdatesPool
+from wire import SKIPPED, NO_DATA
+from benchmarks.synthetic_gtfs import write_feed
+from benchmarks.synthetic_realtime import read_stops, realtime_feeds
+
+DATE = datetime(2015, 6, 10, 8, 15)
+DELAY = 120
+
+@pytest.fixture(scope="module")
+def directory(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("gtfs")
+    write_feed(str(directory / "gtfs"), routes=3, trips_per_route=40, stops_per_trip=10)
+    return directory
+
+@pytest.fixture(scope="module")
+def gtfs_map(directory):
+    return GtfsMap(str(directory / "gtfs"), True, bulk_load=True, db_path=str(directory / "gtfs.db"))
+
+# A synthetic trip updates feed, with its first trip of six or more upcoming
+# stops rewritten to: a delay at the first, SKIPPED at the second, nothing at
+# the third and NO_DATA at the fourth. Returns the feed and that trip's
+# upcoming (stop_sequence, stop_id).
+@pytest.fixture(scope="module")
+def feed(directory, gtfs_map):
+    message = realtime_feeds(gtfs_map, read_stops(str(directory / "gtfs")), DATE, updated=0.5, delayed=0.5, seed=1)[0]
+    for entity in message.entity:
+        updates = entity.trip_update.stop_time_update
+        if len(updates) >= 6:
+            break
+    else:
+        raise Exception("No trip with six upcoming stops")
+    upcoming = [(update.stop_sequence, update.stop_id) for update in updates]
+    del updates[:]
+    for i, schedule_relationship in ((0, None), (1, SKIPPED), (3, NO_DATA)):
+        update = updates.add()
+        update.stop_sequence, update.stop_id = upcoming[i]
+        if schedule_relationship is None:
+            update.arrival.delay = DELAY
+        else:
+            update.schedule_relationship = schedule_relationship
+    return message, entity.trip_update.trip.trip_id, upcoming
+
+def predictions(updates, used_trips):
+    return sorted(updates), sorted(used_trips)
+
+def test_update_paths_agree(gtfs_map, feed):
+    message, trip_id, upcoming = feed
+    data = message.SerializeToString()
+    message_date = datetime.fromtimestamp(message.header.timestamp)
+
+    used_trips = set()
+    expected = predictions(run.iter_updates(message, gtfs_map, used_trips), used_trips)
+    assert expected[0]
+
+    used_trips = set()
+    assert predictions(run.iter_scanned_updates(data, message_date, gtfs_map, used_trips), used_trips) == expected
+
+    pool = UpdatesPool(2)
+    try:
+        used_trips = set()
+        assert predictions(run.iter_pooled_updates(data, message_date, gtfs_map, used_trips, pool), used_trips) == expected
+    finally:
+        pool.close()
+
+def test_skipped_and_no_data(gtfs_map, feed):
+    message, trip_id, upcoming = feed
+    used_trips = set()
+    trip_predictions = dict((prediction.stop_id, prediction.estimated_minutes)
+                            for prediction in run.iter_updates(message, gtfs_map, used_trips) if prediction.trip_id == trip_id)
+
+    arrivals = dict((stop_sequence, arrival_secs) for stop_sequence, stop_id, arrival_secs in gtfs_map.find_stop_times_by_trip([trip_id])[trip_id])
+    now = run.seconds_since_midnight(DATE)
+    def delayed_minutes(i):
+        stop_sequence, stop_id = upcoming[i]
+        return (arrivals[stop_sequence] + DELAY - now) // 60
+
+    # the delay carries over the skipped stop to the one without an update
+    assert trip_predictions == {upcoming[0][1]: delayed_minutes(0), upcoming[2][1]: delayed_minutes(2)}
+    keys = [(stop_id, trip_id, stop_sequence) for stop_sequence, stop_id in upcoming]
+    # skipped stops stay out of the schedule pass, NO_DATA ones and everything
+    # after them are left to it
+    assert keys[1] in used_trips
+    assert not any(key in used_trips for key in keys[3:])
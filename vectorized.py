@@ -0,0 +1,77 @@
+from collections import namedtuple
+from datetime import timedelta
+
+import numpy as np
+
+from stop_times_index import seconds_since_midnight, SECONDS_PER_DAY, WINDOW_SECONDS
+from gtfs_map import Prediction
+
+# a batch of predictions as parallel columns, for PredictionsStore.add_prediction_columns()
+PredictionColumns = namedtuple('PredictionColumns', ['stop_ids', 'trip_ids', 'estimated_minutes'])
+
+# Schedule arrays of a StopTimesIndex viewed as NumPy arrays without copying
+class ScheduleArrays(object):
+    def __init__(self, index):
+        self.index = index
+        self.arrival = np.frombuffer(index.arrival, dtype=np.int32)
+        self.trip = np.frombuffer(index.trip, dtype=np.int32)
+        self.stop = np.frombuffer(index.stop, dtype=np.int32)
+        self.stop_sequence = np.frombuffer(index.stop_sequence, dtype=np.int32)
+        self.trip_service = np.frombuffer(index.trip_service, dtype=np.int32)
+        self.stop_count = max(len(index.stop_ids), 1)
+        self.sequence_limit = int(self.stop_sequence.max()) + 1 if len(self.stop_sequence) else 1
+
+    # (stop, trip, stop_sequence) packed into one int64 so sets of keys can be
+    # matched with np.isin
+    def pack_keys(self, stops, trips, sequences):
+        return (trips.astype(np.int64) * self.stop_count + stops) * self.sequence_limit + sequences
+
+    def pack_used_trips(self, used_trips):
+        stop_lookup = self.index.stop_lookup
+        trip_lookup = self.index.trip_lookup
+        keys = []
+        for stop_id, trip_id, stop_sequence in used_trips:
+            stop = stop_lookup.get(stop_id)
+            trip = trip_lookup.get(trip_id)
+            # keys which aren't in the schedule can't match a row of it
+            if stop is None or trip is None or not 0 <= stop_sequence < self.sequence_limit:
+                continue
+            keys.append((stop, trip, stop_sequence))
+        if not keys:
+            return np.zeros(0, dtype=np.int64)
+        keys = np.array(keys, dtype=np.int64)
+        return self.pack_keys(keys[:, 0], keys[:, 1], keys[:, 2])
+
+    def _service_day(self, service_date, now, used_keys):
+        lo, hi = self.index.window(now - WINDOW_SECONDS, now + WINDOW_SECONDS)
+        trips = self.trip[lo:hi]
+        active = np.frombuffer(self.index.active_services(service_date), dtype=np.uint8)
+        keep = active[self.trip_service[trips]].astype(bool)
+        # now is already shifted a day for yesterday's service
+        seconds_until = self.arrival[lo:hi].astype(np.int64) - now
+        keep &= seconds_until > 0
+        stops = self.stop[lo:hi]
+        if len(used_keys):
+            keep &= ~np.isin(self.pack_keys(stops, trips, self.stop_sequence[lo:hi]), used_keys)
+        return stops[keep], trips[keep], seconds_until[keep] // 60
+
+    # The same predictions as run.iter_scheduled, computed a window at a time
+    def scheduled_columns(self, message_date, used_trips):
+        used_keys = self.pack_used_trips(used_trips)
+        now = seconds_since_midnight(message_date)
+        today = self._service_day(message_date, now, used_keys)
+        # trips belonging to yesterday's service which run past midnight
+        yesterday = self._service_day(message_date + timedelta(-1), now + SECONDS_PER_DAY, used_keys)
+
+        stops = np.concatenate([today[0], yesterday[0]]).tolist()
+        trips = np.concatenate([today[1], yesterday[1]]).tolist()
+        minutes = np.concatenate([today[2], yesterday[2]]).tolist()
+        stop_ids = self.index.stop_ids
+        trip_ids = self.index.trip_ids
+        return PredictionColumns(stop_ids=[stop_ids[stop] for stop in stops],
+                                 trip_ids=[trip_ids[trip] for trip in trips],
+                                 estimated_minutes=minutes)
+
+def to_predictions(columns):
+    return [Prediction(stop_id=stop_id, trip_id=trip_id, estimated_minutes=minutes)
+            for stop_id, trip_id, minutes in zip(columns.stop_ids, columns.trip_ids, columns.estimated_minutes)]
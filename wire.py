@@ -0,0 +1,220 @@
+# Minimal protobuf wire format reader, for peeking into feeds without building
+# gtfs_realtime_pb2 messages
+
+import struct
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# field numbers from gtfs-realtime.proto
+FEED_MESSAGE_HEADER = 1
+FEED_MESSAGE_ENTITY = 2
+FEED_HEADER_TIMESTAMP = 3
+FEED_ENTITY_TRIP_UPDATE = 3
+FEED_ENTITY_VEHICLE = 4
+TRIP_UPDATE_TRIP = 1
+TRIP_UPDATE_STOP_TIME_UPDATE = 2
+TRIP_DESCRIPTOR_TRIP_ID = 1
+STOP_TIME_UPDATE_STOP_SEQUENCE = 1
+STOP_TIME_UPDATE_ARRIVAL = 2
+STOP_TIME_UPDATE_STOP_ID = 4
+STOP_TIME_UPDATE_SCHEDULE_RELATIONSHIP = 5
+STOP_TIME_EVENT_DELAY = 1
+STOP_TIME_EVENT_TIME = 2
+VEHICLE_POSITION_TRIP = 1
+VEHICLE_POSITION_POSITION = 2
+VEHICLE_POSITION_TIMESTAMP = 5
+VEHICLE_POSITION_STOP_ID = 7
+POSITION_LATITUDE = 1
+POSITION_LONGITUDE = 2
+
+# StopTimeUpdate.ScheduleRelationship values
+SCHEDULED = 0
+SKIPPED = 1
+NO_DATA = 2
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+# yields (field number, wire type, value) for each field in buf. value is an int
+# for varints and a memoryview slice of buf for everything else
+def iter_fields(buf):
+    buf = memoryview(buf)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field_number = key >> 3
+        wire_type = key & 0x7
+        if wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise Exception("Unsupported wire type %d" % wire_type)
+        yield field_number, wire_type, value
+
+# yields (field number, start, end) with the byte range of each whole field,
+# tag included, so fields can be copied into a new message as they are
+def iter_field_spans(buf):
+    buf = memoryview(buf)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        start = pos
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 0x7
+        if wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            pos += length
+        elif wire_type == FIXED64:
+            pos += 8
+        elif wire_type == FIXED32:
+            pos += 4
+        else:
+            raise Exception("Unsupported wire type %d" % wire_type)
+        yield key >> 3, start, pos
+
+# Splits a FeedMessage into at most parts smaller FeedMessages, each with the
+# header and a contiguous run of the entities
+def split_feed(data, parts):
+    data = memoryview(data)
+    shared = []
+    entities = []
+    for field_number, start, end in iter_field_spans(data):
+        if field_number == FEED_MESSAGE_ENTITY:
+            entities.append((start, end))
+        else:
+            shared.append((start, end))
+    if not entities:
+        return [data.tobytes()]
+
+    prefix = b"".join(data[start:end] for start, end in shared)
+    size = -(-len(entities) // parts)
+    return [prefix + b"".join(data[start:end] for start, end in entities[i:i + size])
+            for i in range(0, len(entities), size)]
+
+def feed_header_timestamp(data):
+    for field_number, wire_type, value in iter_fields(data):
+        if field_number == FEED_MESSAGE_HEADER and wire_type == LENGTH_DELIMITED:
+            for header_field, header_wire_type, header_value in iter_fields(value):
+                if header_field == FEED_HEADER_TIMESTAMP and header_wire_type == VARINT:
+                    return header_value
+            return None
+    return None
+
+# int32 and int64 fields encode negative numbers as 64 bit two's complement
+def _signed(value):
+    if value >= 1 << 63:
+        return value - (1 << 64)
+    return value
+
+def _string(value):
+    return value.tobytes().decode("utf-8")
+
+def _trip_id(trip_descriptor):
+    for field_number, wire_type, value in iter_fields(trip_descriptor):
+        if field_number == TRIP_DESCRIPTOR_TRIP_ID and wire_type == LENGTH_DELIMITED:
+            return _string(value)
+    return ""
+
+# (time, delay) of a StopTimeEvent, None for either one missing
+def _stop_time_event(event):
+    time = None
+    delay = None
+    for field_number, wire_type, value in iter_fields(event):
+        if wire_type != VARINT:
+            continue
+        if field_number == STOP_TIME_EVENT_TIME:
+            time = _signed(value)
+        elif field_number == STOP_TIME_EVENT_DELAY:
+            delay = _signed(value)
+    return time, delay
+
+# Yields (trip_id, stop_id, stop_sequence, arrival_time, arrival_delay,
+# schedule_relationship) for each StopTimeUpdate in a TripUpdates feed, straight
+# from the wire format without building gtfs_realtime_pb2 messages. Missing
+# strings, stop_sequence and schedule_relationship take the protobuf defaults;
+# arrival_time and arrival_delay are None when missing.
+def scan_trip_updates(data):
+    for field_number, wire_type, entity in iter_fields(data):
+        if field_number != FEED_MESSAGE_ENTITY:
+            continue
+        for entity_field, entity_wire_type, trip_update in iter_fields(entity):
+            if entity_field != FEED_ENTITY_TRIP_UPDATE:
+                continue
+            # the trip descriptor is usually first, but need not be
+            trip_id = ""
+            stop_time_updates = []
+            for update_field, update_wire_type, value in iter_fields(trip_update):
+                if update_field == TRIP_UPDATE_TRIP:
+                    trip_id = _trip_id(value)
+                elif update_field == TRIP_UPDATE_STOP_TIME_UPDATE:
+                    stop_time_updates.append(value)
+
+            for stop_time_update in stop_time_updates:
+                stop_id = ""
+                stop_sequence = 0
+                arrival_time = None
+                arrival_delay = None
+                schedule_relationship = SCHEDULED
+                for update_field, update_wire_type, value in iter_fields(stop_time_update):
+                    if update_field == STOP_TIME_UPDATE_STOP_ID:
+                        stop_id = _string(value)
+                    elif update_field == STOP_TIME_UPDATE_STOP_SEQUENCE:
+                        stop_sequence = value
+                    elif update_field == STOP_TIME_UPDATE_ARRIVAL:
+                        arrival_time, arrival_delay = _stop_time_event(value)
+                    elif update_field == STOP_TIME_UPDATE_SCHEDULE_RELATIONSHIP:
+                        schedule_relationship = value
+                yield trip_id, stop_id, stop_sequence, arrival_time, arrival_delay, schedule_relationship
+
+# Yields (trip_id, stop_id, latitude, longitude, timestamp) for each entity
+# with a VehiclePosition, like scan_trip_updates(). timestamp is None when the
+# vehicle has none.
+def scan_vehicle_positions(data):
+    for field_number, wire_type, entity in iter_fields(data):
+        if field_number != FEED_MESSAGE_ENTITY:
+            continue
+        for entity_field, entity_wire_type, vehicle in iter_fields(entity):
+            if entity_field != FEED_ENTITY_VEHICLE:
+                continue
+            trip_id = ""
+            stop_id = ""
+            latitude = 0.0
+            longitude = 0.0
+            timestamp = None
+            for vehicle_field, vehicle_wire_type, value in iter_fields(vehicle):
+                if vehicle_field == VEHICLE_POSITION_TRIP:
+                    trip_id = _trip_id(value)
+                elif vehicle_field == VEHICLE_POSITION_STOP_ID:
+                    stop_id = _string(value)
+                elif vehicle_field == VEHICLE_POSITION_TIMESTAMP:
+                    timestamp = value
+                elif vehicle_field == VEHICLE_POSITION_POSITION:
+                    for position_field, position_wire_type, position_value in iter_fields(value):
+                        if position_field == POSITION_LATITUDE and position_wire_type == FIXED32:
+                            latitude = struct.unpack("<f", position_value)[0]
+                        elif position_field == POSITION_LONGITUDE and position_wire_type == FIXED32:
+                            longitude = struct.unpack("<f", position_value)[0]
+            yield trip_id, stop_id, latitude, longitude, timestamp